@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+常驻的docker_cli守护进程
+监听Unix套接字，在已导入模块的解释器中执行docker_cli命令，
+省去每次启动Python解释器和导入模块的开销
+"""
+
+import os
+import sys
+import json
+import stat
+import fcntl
+import time
+import socket
+import struct
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .docker_cli import main as docker_cli_main
+from .proot_runner import spawn_process, reset_host_probes
+
+logger = logging.getLogger(__name__)
+
+# 空闲超过该时间（秒）后守护进程自动退出
+IDLE_TIMEOUT = 600
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def code_version():
+    """由包内源文件的名称、大小和修改时间得到的版本标识，代码更新后随之改变"""
+    with os.scandir(_PACKAGE_DIR) as it:
+        files = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                       for entry in it if entry.name.endswith('.py'))
+    return json.dumps(files)
+
+
+def _get_socket_dir():
+    """获取存放套接字的私有目录，不存在时以0700权限创建
+
+    目录必须属于当前用户且其他用户不可访问，否则抛出PermissionError
+    """
+    uid = os.getuid()
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        socket_dir = os.path.join(runtime_dir, 'android-docker')
+    else:
+        socket_dir = os.path.join(tempfile.gettempdir(), f'android-docker-{uid}')
+    try:
+        os.mkdir(socket_dir, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(socket_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or st.st_mode & 0o077:
+        raise PermissionError(f"守护进程套接字目录不安全: {socket_dir}")
+    return socket_dir
+
+
+def get_socket_path():
+    """获取守护进程套接字路径"""
+    return os.path.join(_get_socket_dir(), 'android-docker.sock')
+
+
+def _peer_uid(sock):
+    """通过SO_PEERCRED获取对端进程的uid，平台不支持时返回None"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _check_peer(sock):
+    """对端不是当前用户的进程时抛出PermissionError"""
+    uid = _peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        raise PermissionError(f"拒绝其他用户(uid={uid})的守护进程连接")
+
+
+def _run_one(argv):
+    """执行一条docker_cli命令，失败时返回True"""
+    try:
+        docker_cli_main(argv)
+    except SystemExit as e:
+        return e.code not in (None, 0)
+    return False
+
+
+def run_stages(stages):
+    """按阶段执行命令：阶段之间顺序执行，同一阶段内并发执行，返回失败的命令数"""
+    failed = 0
+    for stage in stages:
+        if len(stage) == 1:
+            failed += _run_one(stage[0])
+            continue
+        with ThreadPoolExecutor(max_workers=min(len(stage), (os.cpu_count() or 1) * 2)) as executor:
+            failed += sum(executor.map(_run_one, stage))
+    return failed
+
+
+def _receive_request(conn):
+    """读取客户端传来的标准输入输出描述符和JSON请求"""
+    _, fds, _, _ = socket.recv_fds(conn, 1, 3)
+    try:
+        chunks = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return fds, json.loads(b''.join(chunks))
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+def _execute(fds, request):
+    """换上客户端的标准输入输出、环境变量和工作目录后执行命令，返回退出状态"""
+    saved = [os.dup(fd) for fd in (0, 1, 2)]
+    saved_env = dict(os.environ)
+    cwd = os.getcwd()
+    # 客户端的 --verbose 会调整根日志级别，执行后恢复为守护进程原来的级别
+    root_logger = logging.getLogger()
+    saved_level = root_logger.level
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+        # 客户端的PATH可能不同，期间也可能安装了proot等命令，不沿用上一个请求的探测结果
+        reset_host_probes()
+        failed = run_stages(request['stages'])
+    except Exception as e:
+        logger.error(f"守护进程执行命令失败: {e}")
+        failed = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for target, fd in enumerate(saved):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        root_logger.setLevel(saved_level)
+    return 1 if failed else 0
+
+
+def _acquire_socket_lock(sock_path):
+    """获取套接字旁的文件锁，已有守护进程持有时返回None
+
+    守护进程在整个运行期间持有该锁，锁被释放（包括进程崩溃）后套接字路径才可能被替换
+    """
+    lock = open(sock_path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def _stop_listening(server, sock_path, inode, lock):
+    """关闭监听套接字，只在路径仍指向本进程绑定的套接字时删除它，然后释放文件锁
+
+    释放锁后路径可能已属于新的守护进程（inode也可能被重用），再次调用时不做任何事
+    """
+    if lock.closed:
+        return
+    server.close()
+    try:
+        if os.lstat(sock_path).st_ino == inode:
+            os.unlink(sock_path)
+    except FileNotFoundError:
+        pass
+    lock.close()
+
+
+def serve(sock_path=None, idle_timeout=IDLE_TIMEOUT):
+    """监听套接字并依次处理请求，空闲超时或客户端代码版本不同时退出
+
+    已有守护进程在运行时直接返回，客户端会连接到那个守护进程
+    """
+    sock_path = sock_path or get_socket_path()
+    version = code_version()
+    lock = _acquire_socket_lock(sock_path)
+    if lock is None:
+        return
+    # 持有锁时路径上的套接字只可能是已退出的守护进程留下的
+    try:
+        os.unlink(sock_path)
+    except FileNotFoundError:
+        pass
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(sock_path)
+    finally:
+        os.umask(old_umask)
+    inode = os.lstat(sock_path).st_ino
+    server.listen()
+    server.settimeout(idle_timeout)
+
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            # 请求之间串行执行，标准输入输出的重定向作用于整个进程
+            with conn:
+                conn.settimeout(None)
+                try:
+                    _check_peer(conn)
+                    fds, request = _receive_request(conn)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"处理守护进程请求失败: {e}")
+                    continue
+                try:
+                    if request.get('version') != version:
+                        # 先释放套接字路径，客户端随后启动的新守护进程才能绑定
+                        _stop_listening(server, sock_path, inode, lock)
+                        conn.sendall(json.dumps({'stale': True}).encode())
+                        return
+                    status = _execute(fds, request)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                try:
+                    conn.sendall(json.dumps({'status': status}).encode())
+                except OSError as e:
+                    logger.warning(f"回传执行结果失败: {e}")
+    finally:
+        _stop_listening(server, sock_path, inode, lock)
+
+
+def _start_daemon():
+    """在新会话中启动守护进程
+
+    spawn_process优先使用posix_spawn的setsid，平台不支持时退回subprocess
+    """
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        spawn_process(
+            [sys.executable, '-m', 'android_docker.cli_daemon'],
+            os.environ,
+            (devnull, devnull, devnull),
+            new_session=True,
+        )
+    finally:
+        os.close(devnull)
+
+
+def _try_connect(sock_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(sock_path)
+        _check_peer(client)
+    except OSError:
+        client.close()
+        raise
+    return client
+
+
+def _connect(sock_path, timeout=5.0):
+    """连接守护进程，不存在时启动一个并等待其就绪"""
+    try:
+        return _try_connect(sock_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+
+    _start_daemon()
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        try:
+            return _try_connect(sock_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+
+def _request(sock_path, request):
+    """发送一次请求并返回守护进程的JSON回复"""
+    with _connect(sock_path) as client:
+        socket.send_fds(client, [b'\0'], [0, 1, 2])
+        client.sendall(json.dumps(request).encode())
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b''.join(chunks))
+
+
+def send_stages(stages, sock_path=None):
+    """通过守护进程执行命令，返回退出状态
+
+    每次请求都带上当前的环境变量、工作目录和代码版本；守护进程的代码版本不同时
+    它会在执行前退出，此时启动新的守护进程重试一次。
+    无法连接守护进程时抛出OSError，回复无法解析时抛出ValueError或KeyError，由调用方回退到子进程执行
+    """
+    sock_path = sock_path or get_socket_path()
+    request = {'version': code_version(), 'env': dict(os.environ), 'cwd': os.getcwd(), 'stages': stages}
+    reply = _request(sock_path, request)
+    if reply.get('stale'):
+        logger.debug("docker_cli守护进程的代码版本已过期，重新启动")
+        reply = _request(sock_path, request)
+    if 'status' not in reply:
+        raise ConnectionError("docker_cli守护进程的代码版本与客户端不一致")
+    return reply['status']
+
+
+if __name__ == '__main__':
+    serve()
@@ -16,19 +16,42 @@ import json
 import hashlib
 import tarfile
 import gzip
-import time
-from pathlib import Path
-from urllib.parse import urlparse
 import platform
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 超过该大小的层拆成多个Range请求并发下载
+_RANGED_DOWNLOAD_THRESHOLD = 32 * 1024 * 1024
+_RANGED_DOWNLOAD_PARTS = 4
+
+# 摘要探测每条curl命令的连接超时和总超时（秒），网络不通时尽快改用缓存
+_PROBE_CONNECT_TIMEOUT = 3
+_PROBE_MAX_TIME = 5
+
+class _DebugLogAdapter(logging.LoggerAdapter):
+    """把所有级别的日志都降为DEBUG，用于后台探测：失败时由调用方决定如何提示"""
+
+    def log(self, level, msg, *args, **kwargs):
+        super().log(logging.DEBUG, msg, *args, **kwargs)
+
+
+# 获取manifest时接受的格式
+_MANIFEST_MEDIA_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+
+
 class DockerRegistryClient:
     """Docker Registry API客户端，使用curl下载镜像"""
 
-    def __init__(self, registry_url, image_name, tag='latest', username=None, password=None, verbose=False):
+    def __init__(self, registry_url, image_name, tag='latest', username=None, password=None, verbose=False,
+                 log=None, max_time=None):
         self.registry_url = registry_url
         self.image_name = image_name
         self.tag = tag
@@ -37,6 +60,10 @@ class DockerRegistryClient:
         self.username = username
         self.password = password
         self.verbose = verbose
+        # 记录请求过程的日志器，只做探测时传入_DebugLogAdapter
+        self.logger = log or logger
+        # 每条curl命令的最长执行时间（秒），None表示不限制；只做探测时设置
+        self.max_time = max_time
 
     def _run_curl_command(self, cmd, print_cmd=True, show_progress=True):
         """执行并打印curl命令"""
@@ -50,7 +77,7 @@ class DockerRegistryClient:
                     safe_cmd.append(f"{cmd[i+1].split(':')[0]}:***")
                     i += 1
                 i += 1
-            logger.info(f"---\n[ 执行命令 ]\n{' '.join(safe_cmd)}\n---")
+            self.logger.info(f"---\n[ 执行命令 ]\n{' '.join(safe_cmd)}\n---")
         
         # 添加进度条参数
         if show_progress and '-o' in cmd and not self.verbose:
@@ -63,17 +90,24 @@ class DockerRegistryClient:
             except (ValueError, IndexError):
                 pass
         
+        timeout = None
+        if self.max_time is not None:
+            cmd[1:1] = ['--connect-timeout', str(min(_PROBE_CONNECT_TIMEOUT, self.max_time)),
+                        '--max-time', str(self.max_time)]
+            # curl自身的超时之外再留一秒余量，防止curl卡在DNS解析等处不退出
+            timeout = self.max_time + 1
+
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=timeout)
             if not result.stdout and not result.stderr:
                 # 记录警告而不是抛出异常，以增加网络弹性
                 if self.verbose:
-                    logger.warning(f"curl命令返回空响应: {' '.join(cmd)}")
+                    self.logger.warning(f"curl命令返回空响应: {' '.join(cmd)}")
             return result
         except subprocess.CalledProcessError as e:
-            logger.error(f"!!! curl命令执行失败 (错误码: {e.returncode}) !!!")
+            self.logger.error(f"!!! curl命令执行失败 (错误码: {e.returncode}) !!!")
             if self.verbose:
-                logger.error(f"""---
+                self.logger.error(f"""---
 [ 错误输出 ]
 ---\n{e.stderr.strip()}""")
             raise
@@ -115,37 +149,37 @@ class DockerRegistryClient:
                     # 为了简单起见，我们直接调用，不再通过_run_curl_command
                     # 因为代理已经通过环境变量设置
                     if self.verbose:
-                        logger.info("""---
+                        self.logger.info("""---
 [ 步骤 2/3: 获取认证Token ]
 ---""")
                     else:
-                        logger.info("获取认证Token...")
+                        self.logger.info("获取认证Token...")
                     result = self._run_curl_command(cmd, print_cmd=self.verbose)
                     token_data = json.loads(result.stdout)
                     if not self.verbose:
-                        logger.info("✓ 成功获取认证Token")
+                        self.logger.info("✓ 成功获取认证Token")
                     return token_data.get('token')
                 except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
-                    logger.warning(f"获取认证token失败: {e}")
+                    self.logger.warning(f"获取认证token失败: {e}")
                     # 在失败时打印可手动执行的命令
                     if isinstance(e, subprocess.CalledProcessError) and self.verbose:
-                        logger.warning(f"您可以手动运行以下命令测试token获取:\n{' '.join(cmd)}")
+                        self.logger.warning(f"您可以手动运行以下命令测试token获取:\n{' '.join(cmd)}")
                     return None
 
         return None
 
-    def _make_registry_request(self, path, headers=None, output_file=None):
-        """向registry发送请求，处理认证"""
+    def _make_registry_request(self, path, headers=None, output_file=None, head=False):
+        """向registry发送请求，处理认证；head为True时只发HEAD请求获取响应头"""
         # 步骤1：先发一个请求获取认证头
         if not self.auth_token:
             url = f"{self.registry_url}/v2/{path}"
             cmd = ['curl', '-v', '-i', '--insecure', url]
             if self.verbose:
-                logger.info("""---
+                self.logger.info("""---
 [ 步骤 1/3: 探测认证服务器 ]
 ---""")
             else:
-                logger.info("探测认证服务器...")
+                self.logger.info("探测认证服务器...")
             result = self._run_curl_command(cmd, print_cmd=self.verbose)
             
             auth_header = None
@@ -160,21 +194,21 @@ class DockerRegistryClient:
                 if token:
                     self.auth_token = token
                     if not self.verbose:
-                        logger.info("✓ 成功获取认证Token")
+                        self.logger.info("✓ 成功获取认证Token")
                 else:
-                    logger.warning("无法获取认证token，将尝试匿名访问")
+                    self.logger.warning("无法获取认证token，将尝试匿名访问")
             else:
                 if self.verbose:
-                    logger.info("无需认证")
+                    self.logger.info("无需认证")
 
         # 步骤3：使用token发送实际请求
         if self.verbose:
-            logger.info("""---
+            self.logger.info("""---
 [ 步骤 3/3: 获取镜像Manifest ]
 ---""")
         
         url = f"{self.registry_url}/v2/{path}"
-        cmd = ['curl', '-v', '-i', '--insecure', '-H', f'User-Agent: {self.user_agent}']
+        cmd = ['curl', '-v', '-I' if head else '-i', '--insecure', '-H', f'User-Agent: {self.user_agent}']
         
         # 添加Accept头
         if headers and 'Accept' in headers:
@@ -240,20 +274,13 @@ class DockerRegistryClient:
     def get_manifest(self):
         """获取镜像manifest"""
         if self.verbose:
-            logger.info(f"获取镜像manifest: {self.image_name}:{self.tag}")
+            self.logger.info(f"获取镜像manifest: {self.image_name}:{self.tag}")
         else:
-            logger.info(f"获取镜像信息: {self.image_name}:{self.tag}")
+            self.logger.info(f"获取镜像信息: {self.image_name}:{self.tag}")
 
         # 支持多种manifest格式
-        accept_headers = [
-            'application/vnd.docker.distribution.manifest.v2+json',
-            'application/vnd.docker.distribution.manifest.list.v2+json',
-            'application/vnd.oci.image.manifest.v1+json',
-            'application/vnd.oci.image.index.v1+json'
-        ]
-
         headers = {
-            'Accept': ', '.join(accept_headers)
+            'Accept': ', '.join(_MANIFEST_MEDIA_TYPES)
         }
 
         path = f"{self.image_name}/manifests/{self.tag}"
@@ -262,8 +289,8 @@ class DockerRegistryClient:
         try:
             # 添加调试信息
             if self.verbose:
-                logger.debug(f"Response body (first 200 chars): {response['body'][:200]}")
-                logger.debug(f"Response headers: {response['headers']}")
+                self.logger.debug(f"Response body (first 200 chars): {response['body'][:200]}")
+                self.logger.debug(f"Response headers: {response['headers']}")
             
             # 清理响应体 - 移除可能的多余空行和curl输出
             body = response['body'].strip()
@@ -278,28 +305,34 @@ class DockerRegistryClient:
             if json_start > 0:
                 body = body[json_start:]
                 if self.verbose:
-                    logger.debug(f"Cleaned body (first 200 chars): {body[:200]}")
+                    self.logger.debug(f"Cleaned body (first 200 chars): {body[:200]}")
             
             manifest = json.loads(body)
             content_type = response['headers'].get('content-type', '')
         except json.JSONDecodeError as e:
-            logger.error(f"JSON解析失败: {e}")
-            logger.error(f"响应体内容: {response['body'][:500]}")
-            logger.error(f"响应头: {response['headers']}")
+            self.logger.error(f"JSON解析失败: {e}")
+            self.logger.error(f"响应体内容: {response['body'][:500]}")
+            self.logger.error(f"响应头: {response['headers']}")
             raise
 
         if self.verbose:
-            logger.info(f"Manifest类型: {content_type}")
+            self.logger.info(f"Manifest类型: {content_type}")
         return manifest, content_type
 
+    def get_manifest_digest(self):
+        """用HEAD请求获取标签当前指向的manifest摘要（Docker-Content-Digest头），不下载manifest"""
+        path = f"{self.image_name}/manifests/{self.tag}"
+        response = self._make_registry_request(path, {'Accept': ', '.join(_MANIFEST_MEDIA_TYPES)}, head=True)
+        return response['headers'].get('docker-content-digest')
+
     def download_blob(self, digest, output_path):
         """下载blob到指定路径"""
         if self.verbose:
-            logger.info(f"下载blob: {digest}")
+            self.logger.info(f"下载blob: {digest}")
         else:
             # 显示简化的下载信息
             blob_name = digest.split(':')[-1][:12]  # 显示前12位
-            logger.info(f"下载: {blob_name}...")
+            self.logger.info(f"下载: {blob_name}...")
 
         path = f"{self.image_name}/blobs/{digest}"
 
@@ -316,11 +349,134 @@ class DockerRegistryClient:
         self._run_curl_command(cmd, print_cmd=self.verbose, show_progress=not self.verbose)
 
         if not self.verbose:
-            logger.info("✓ 下载完成")
+            self.logger.info("✓ 下载完成")
         return output_path
 
+    def download_blob_ranged(self, digest, output_path, size, parts=_RANGED_DOWNLOAD_PARTS):
+        """把blob拆成多个Range请求并发下载，合并时计算sha256校验
+
+        服务器不支持Range请求或校验失败时抛出ValueError
+        """
+        blob_name = digest.split(':')[-1][:12]
+        self.logger.info(f"分段下载: {blob_name}... ({size / 1024 / 1024:.1f} MB, {parts} 段)")
+
+        url = f"{self.registry_url}/v2/{self.image_name}/blobs/{digest}"
+        chunk = -(-size // parts)
+        ranges = [(start, min(start + chunk, size) - 1) for start in range(0, size, chunk)]
+        part_paths = [f"{output_path}.part{i}" for i in range(len(ranges))]
+
+        def fetch(index):
+            start, end = ranges[index]
+            cmd = ['curl', '-sS', '-L', '--fail', '-r', f'{start}-{end}',
+                   '-H', f'User-Agent: {self.user_agent}', '-w', '%{response_code}']
+            if self.auth_token:
+                cmd.extend(['-H', f'Authorization: Bearer {self.auth_token}'])
+            cmd.extend(['-o', part_paths[index], url])
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            # 服务器忽略Range时会返回200和完整内容
+            if result.stdout.strip() != '206' or os.path.getsize(part_paths[index]) != end - start + 1:
+                raise ValueError(f"服务器不支持Range请求 (HTTP {result.stdout.strip()})")
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                list(executor.map(fetch, range(len(ranges))))
+
+            # 按顺序合并分段，边写边计算摘要
+            sha256 = hashlib.sha256()
+            with open(output_path, 'wb') as out:
+                for part_path in part_paths:
+                    with open(part_path, 'rb') as part:
+                        while True:
+                            data = part.read(1024 * 1024)
+                            if not data:
+                                break
+                            sha256.update(data)
+                            out.write(data)
+            if digest.startswith('sha256:') and sha256.hexdigest() != digest[7:]:
+                os.remove(output_path)
+                raise ValueError(f"blob校验失败: {digest}")
+        finally:
+            for part_path in part_paths:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+
+        self.logger.info("✓ 下载完成")
+        return output_path
+
+    def download_blobs(self, blobs, max_conns=1, on_complete=None):
+        """在同一个curl进程中下载多个blob，复用TCP/TLS连接
+
+        blobs为(digest, output_path)列表；max_conns大于1时允许curl并发使用
+        最多max_conns个连接。提供on_complete时，每个blob下载完成后立即以其
+        输出路径回调，而不是等待整个curl进程结束
+        """
+        if not blobs:
+            return []
+
+        if on_complete:
+            return self._stream_blobs(blobs, max_conns, on_complete)
+
+        if self.verbose:
+            self.logger.info(f"批量下载 {len(blobs)} 个blob (keep-alive, 最大连接数: {max_conns})")
+        else:
+            self.logger.info(f"下载 {len(blobs)} 个层...")
+
+        cmd = ['curl', '-v', '-L', '--fail', '--keepalive-time', '60',
+               '-H', f'User-Agent: {self.user_agent}']
+
+        # 如果有认证token，添加Authorization头
+        if self.auth_token:
+            cmd.extend(['-H', f'Authorization: Bearer {self.auth_token}'])
+
+        if max_conns > 1:
+            cmd.extend(['--parallel', '--parallel-max', str(max_conns)])
+
+        for digest, output_path in blobs:
+            url = f"{self.registry_url}/v2/{self.image_name}/blobs/{digest}"
+            cmd.extend(['-o', output_path, url])
+
+        self._run_curl_command(cmd, print_cmd=self.verbose, show_progress=not self.verbose)
+
+        if not self.verbose:
+            self.logger.info("✓ 下载完成")
+        return [output_path for _, output_path in blobs]
+
+    def _stream_blobs(self, blobs, max_conns, on_complete):
+        """下载blob并通过curl的--write-out逐个报告完成的传输"""
+        cmd = ['curl', '-sS', '-L', '--keepalive-time', '60',
+               '-H', f'User-Agent: {self.user_agent}',
+               '-w', '%{response_code} %{filename_effective}\\n']
+
+        if self.auth_token:
+            cmd.extend(['-H', f'Authorization: Bearer {self.auth_token}'])
+
+        if max_conns > 1:
+            cmd.extend(['--parallel', '--parallel-max', str(max_conns)])
+
+        for digest, output_path in blobs:
+            url = f"{self.registry_url}/v2/{self.image_name}/blobs/{digest}"
+            cmd.extend(['-o', output_path, url])
+
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        failed = []
+        for line in process.stdout:
+            status, _, output_path = line.rstrip('\n').partition(' ')
+            if status.startswith('2'):
+                on_complete(output_path)
+            else:
+                failed.append(f"{output_path} (HTTP {status})")
+        stderr = process.stderr.read()
+        returncode = process.wait()
+
+        if returncode != 0 or failed:
+            if failed:
+                self.logger.error(f"下载失败: {', '.join(failed)}")
+            raise subprocess.CalledProcessError(returncode or 22, cmd, stderr=stderr)
+        return [output_path for _, output_path in blobs]
+
 class DockerImageToRootFS:
-    def __init__(self, image_url, output_path=None, username=None, password=None, architecture=None, verbose=False, quiet=False):
+    def __init__(self, image_url, output_path=None, username=None, password=None, architecture=None, verbose=False, quiet=False,
+                 keep_alive=False, max_conns=1, parallel=1):
         self.image_url = image_url
         self.output_path = output_path or f"{self._get_image_name()}_rootfs.tar"
         self.temp_dir = None
@@ -329,6 +485,13 @@ class DockerImageToRootFS:
         self.architecture = architecture or self._get_current_architecture()
         self.verbose = verbose
         self.quiet = quiet
+        self.keep_alive = keep_alive
+        self.max_conns = max(1, max_conns)
+        self.parallel = max(1, parallel)
+        self._download_executor = None
+        self._blob_futures = {}
+        self._blob_sizes = {}
+        self._android = None
         if not quiet:
             logger.info(f"目标架构: {self.architecture}")
         
@@ -356,25 +519,13 @@ class DockerImageToRootFS:
     
     def _check_dependencies(self):
         """检查curl是否已安装"""
-        # 检查curl
-        try:
-            subprocess.run(['curl', '--version'],
-                         capture_output=True, check=True)
-            logger.info("✓ curl 已安装")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ curl 未安装")
-            logger.info("请安装curl命令行工具")
-            return False
-
-        # 检查tar命令
-        try:
-            subprocess.run(['tar', '--version'],
-                         capture_output=True, check=True)
-            logger.info("✓ tar 已安装")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ tar 未安装")
-            logger.info("请安装tar命令行工具")
-            return False
+        # 只在PATH中查找，不为每个命令fork一次 --version
+        for name in ('curl', 'tar'):
+            if not shutil.which(name):
+                logger.error(f"✗ {name} 未安装")
+                logger.info(f"请安装{name}命令行工具")
+                return False
+            logger.info(f"✓ {name} 已安装")
 
         return True
     
@@ -454,7 +605,8 @@ class DockerImageToRootFS:
         if not registry.startswith(('http://', 'https://')):
             registry = f"https://{registry}"
 
-        logger.info(f"解析镜像URL: registry={registry}, image={image_name}, tag={tag}")
+        if not self.quiet:
+            logger.info(f"解析镜像URL: registry={registry}, image={image_name}, tag={tag}")
         return registry, image_name, tag
     
     def _download_image_with_python(self):
@@ -580,6 +732,7 @@ class DockerImageToRootFS:
             digest_hash = digest
 
         config_path = os.path.join(blobs_dir, digest_hash)
+        self._wait_for_blob(config_path)
 
         # 读取原始config
         if not os.path.exists(config_path):
@@ -641,7 +794,8 @@ class DockerImageToRootFS:
             # Docker v2 manifest 或 OCI manifest
             layers = manifest['layers'][:]
             if 'config' in manifest:
-                layers.append(manifest['config'])
+                # config最先下载，后续的格式转换需要立即读取它
+                layers.insert(0, manifest['config'])
         elif 'fsLayers' in manifest and manifest['fsLayers']:
             # Docker v1 manifest (已废弃，但仍需支持)
             layers = manifest['fsLayers'][:]
@@ -652,6 +806,7 @@ class DockerImageToRootFS:
         elif not layers:
             raise ValueError("Manifest中没有找到'layers'或'fsLayers'字段，或者它们为空")
 
+        pending = []
         for layer in layers:
             digest = layer.get('digest') or layer.get('blobSum')
             if digest:
@@ -663,12 +818,88 @@ class DockerImageToRootFS:
 
                 blob_path = os.path.join(blobs_dir, digest_hash)
                 if not os.path.exists(blob_path):
-                    try:
-                        client.download_blob(digest, blob_path)
-                        logger.debug(f"已下载层: {digest}")
-                    except Exception as e:
-                        logger.error(f"下载层失败 {digest}: {e}")
-                        raise
+                    pending.append((digest, blob_path))
+                    self._blob_sizes[blob_path] = layer.get('size', 0)
+
+        # 并行模式下层在后台下载，提取阶段按顺序等待每一层完成
+        if self.parallel > 1 and len(pending) > 1:
+            self._start_parallel_download(client, pending)
+            return
+
+        # keep-alive模式下所有层在同一个curl进程中下载，复用连接；大层单独分段下载
+        batch = [item for item in pending if not self._is_ranged(item)]
+        if self.keep_alive and len(batch) > 1:
+            try:
+                client.download_blobs(batch, max_conns=self.max_conns)
+                logger.debug(f"已批量下载 {len(batch)} 个层")
+                pending = [item for item in pending if self._is_ranged(item)]
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"批量下载失败，回退到逐层下载: {e}")
+
+        for digest, blob_path in pending:
+            try:
+                self._fetch_blob(client, digest, blob_path)
+                logger.debug(f"已下载层: {digest}")
+            except Exception as e:
+                logger.error(f"下载层失败 {digest}: {e}")
+                raise
+
+    def _is_ranged(self, item):
+        """判断 (digest, blob_path) 是否大到需要分段下载"""
+        return self._blob_sizes.get(item[1], 0) > _RANGED_DOWNLOAD_THRESHOLD
+
+    def _fetch_blob(self, client, digest, blob_path):
+        """下载单个blob，大层优先分段并发下载，失败时回退到整体下载"""
+        if self._is_ranged((digest, blob_path)):
+            try:
+                return client.download_blob_ranged(digest, blob_path, self._blob_sizes[blob_path])
+            except (subprocess.CalledProcessError, ValueError) as e:
+                logger.warning(f"分段下载失败，回退到整体下载: {e}")
+        return client.download_blob(digest, blob_path)
+
+    def _start_parallel_download(self, client, pending):
+        """在线程池中下载层，使下载与提取重叠进行"""
+        workers = min(self.parallel, len(pending))
+        if self.keep_alive:
+            workers = min(workers, self.max_conns)
+        logger.info(f"并行下载 {len(pending)} 个层 (线程数: {workers})")
+
+        self._download_executor = ThreadPoolExecutor(max_workers=workers)
+        for _, blob_path in pending:
+            self._blob_futures[blob_path] = Future()
+
+        # 按轮转方式分片，保证靠前的层尽早下载完成
+        for i in range(workers):
+            self._download_executor.submit(self._download_shard, client, pending[i::workers])
+
+    def _download_shard(self, client, shard):
+        """下载一个分片中的层，并在每层完成时通知等待者"""
+        try:
+            if self.keep_alive:
+                batch = [item for item in shard if not self._is_ranged(item)]
+                client.download_blobs(batch, on_complete=lambda path: self._blob_futures[path].set_result(path))
+                shard = [item for item in shard if self._is_ranged(item)]
+            for digest, blob_path in shard:
+                self._fetch_blob(client, digest, blob_path)
+                self._blob_futures[blob_path].set_result(blob_path)
+        except Exception as e:
+            logger.error(f"下载层失败: {e}")
+            for _, blob_path in shard:
+                future = self._blob_futures[blob_path]
+                if not future.done():
+                    future.set_exception(e)
+
+    def _wait_for_blob(self, blob_path):
+        """等待后台下载的blob完成，非并行模式下直接返回"""
+        future = self._blob_futures.get(blob_path)
+        if future:
+            future.result()
+
+    def _shutdown_download_executor(self):
+        """等待并关闭后台下载线程池"""
+        if self._download_executor:
+            self._download_executor.shutdown(wait=True)
+            self._download_executor = None
 
     def _create_oci_index(self, oci_dir, manifest_digest, content_type):
         """创建OCI index.json文件"""
@@ -798,6 +1029,7 @@ class DockerImageToRootFS:
             layer_digest = layer['digest']
             layer_path = os.path.join(oci_dir, 'blobs', 'sha256', layer_digest[7:])
 
+            self._wait_for_blob(layer_path)
             logger.info(f"提取层 {i}/{len(layers)}: {layer_digest}")
 
             # 第一层使用严格模式，后续层使用宽松模式
@@ -978,15 +1210,16 @@ class DockerImageToRootFS:
             logger.debug(f"手动创建符号链接失败 {member.name}: {e}")
 
     def _is_android_environment(self):
-        """检测是否在Android环境中运行"""
-        android_indicators = [
-            '/data/data/com.termux' in os.getcwd(),
-            os.path.exists('/system/build.prop'),
-            os.environ.get('ANDROID_DATA') is not None,
-            os.environ.get('TERMUX_VERSION') is not None
-        ]
-
-        return any(android_indicators)
+        """检测是否在Android环境中运行，结果在实例内缓存"""
+        if self._android is None:
+            # 按开销从小到大检查并短路：环境变量 → stat → getcwd
+            self._android = (
+                os.environ.get('TERMUX_VERSION') is not None
+                or os.environ.get('ANDROID_DATA') is not None
+                or os.path.exists('/system/build.prop')
+                or '/data/data/com.termux' in os.getcwd()
+            )
+        return self._android
 
     def _extract_layer_with_tar(self, layer_path, rootfs_dir, is_first_layer=False):
         """使用tar命令提取层（备用方案）"""
@@ -1094,7 +1327,15 @@ class DockerImageToRootFS:
 
     
     def _create_tar_archive(self, rootfs_dir):
-        """创建tar归档文件"""
+        """创建tar归档文件，输出路径为 - 时写到标准输出"""
+        if self.output_path == '-':
+            # 直接写到stdout，调用方可以边接收边解压
+            logger.info("执行命令: tar -czf - -C " + rootfs_dir + " .")
+            sys.stdout.flush()
+            subprocess.run(['tar', '-czf', '-', '-C', rootfs_dir, '.'], check=True)
+            logger.info("根文件系统tar包已写入标准输出")
+            return self.output_path
+
         output_path = os.path.abspath(self.output_path)
         
         # 使用tar命令创建归档，保持权限和所有者信息
@@ -1194,6 +1435,9 @@ class DockerImageToRootFS:
             logger.info("步骤 5/5: 创建tar归档...")
             output_file = self._create_tar_archive(rootfs_dir)
             
+            if output_file == '-':
+                return True
+
             logger.info(f"✓ 成功创建根文件系统tar包: {output_file}")
             logger.info(f"文件大小: {os.path.getsize(output_file) / 1024 / 1024:.2f} MB")
             
@@ -1206,6 +1450,7 @@ class DockerImageToRootFS:
             logger.error(f"处理失败: {str(e)}")
             return False
         finally:
+            self._shutdown_download_executor()
             # 清理临时目录
             self._cleanup_temp_directory()
     
@@ -1227,7 +1472,25 @@ class DockerImageToRootFS:
         logger.info("注意: 此脚本仅需要curl和tar命令行工具，无需skopeo、umoci和requests库")
         logger.info("使用Python标准库实现镜像解包，适合在各种环境中运行")
 
-def main():
+def get_manifest_digest(image_url, username=None, password=None):
+    """查询镜像标签当前指向的manifest摘要，查询失败时返回None
+
+    请求过程和失败原因只记录在DEBUG级别，离线时由调用方改用缓存并给出提示；
+    每条curl命令都有超时限制，网络不通或被拦截时也能很快返回None
+    """
+    converter = DockerImageToRootFS(image_url, username=username, password=password, quiet=True)
+    registry, image_name, tag = converter._parse_image_url()
+    client = DockerRegistryClient(registry, image_name, tag, username, password,
+                                  log=_DebugLogAdapter(logger, {}), max_time=_PROBE_MAX_TIME)
+    try:
+        return client.get_manifest_digest()
+    except Exception as e:
+        logger.debug(f"查询镜像摘要失败: {e}")
+        return None
+
+
+def create_parser():
+    """创建命令行解析器"""
     parser = argparse.ArgumentParser(
         description='使用curl和Python制作Docker镜像的根文件系统tar包'
     )
@@ -1239,7 +1502,7 @@ def main():
     )
     parser.add_argument(
         '-o', '--output',
-        help='输出tar文件路径 (默认: 基于镜像名称自动生成)'
+        help='输出tar文件路径，- 表示写到标准输出 (默认: 基于镜像名称自动生成)'
     )
     parser.add_argument(
         '-v', '--verbose',
@@ -1270,7 +1533,30 @@ def main():
         action='store_true',
         help='简洁模式：减少冗余输出，显示下载进度'
     )
-    
+
+    parser.add_argument(
+        '--keep-alive',
+        action='store_true',
+        help='在同一个curl进程中下载所有层，复用TCP/TLS连接'
+    )
+    parser.add_argument(
+        '--max-conns',
+        type=int,
+        default=1,
+        help='keep-alive模式下curl最多同时使用的连接数 (默认: 1)'
+    )
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        default=1,
+        help='并行下载层的线程数，下载与提取重叠进行 (默认: 1)'
+    )
+
+    return parser
+
+
+def main():
+    parser = create_parser()
     args = parser.parse_args()
     
     if args.verbose:
@@ -1284,7 +1570,8 @@ def main():
     logger.info("🚀 [版本标识] create_rootfs_tar.py v2.0 - 已优化硬链接处理")
     
     # 将代理参数传递给处理器
-    processor = DockerImageToRootFS(args.image_url, args.output, args.username, args.password, args.arch, args.verbose, args.quiet)
+    processor = DockerImageToRootFS(args.image_url, args.output, args.username, args.password, args.arch, args.verbose, args.quiet,
+                                    keep_alive=args.keep_alive, max_conns=args.max_conns, parallel=args.parallel)
     # 在客户端中也需要设置代理
     if args.proxy:
         # 这是个简化处理，理想情况下应该在DockerRegistryClient中处理
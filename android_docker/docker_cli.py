@@ -8,26 +8,86 @@ Docker风格的命令行接口
 import os
 import sys
 import argparse
+import contextlib
 import json
 import logging
 import time
 import subprocess
 import signal
-from pathlib import Path
+import threading
 from datetime import datetime
 import getpass
+import fcntl
+import importlib.util
+import itertools
+import traceback
+import shlex
 from urllib.parse import urlparse
 
 # 导入现有模块
-from .proot_runner import ProotRunner
-from .create_rootfs_tar import DockerImageToRootFS
+from .proot_runner import ProotRunner, main as proot_runner_main
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+
+# 统计目录大小时默认计入所有文件；目录树很大时可以设置环境变量ANDROID_DOCKER_SIZE_PRUNE
+# （逗号分隔的目录名，".*"表示所有隐藏目录，如 ".*,proc,sys,dev"）跳过这些目录，只统计有效大小
+def _get_size_prune_names():
+    names = {name.strip() for name in os.environ.get('ANDROID_DOCKER_SIZE_PRUNE', '').split(',')}
+    names.discard('')
+    return frozenset(names)
+
+
+# docker help的输出，一次性写入stdout
+_HELP_TEXT = (
+    "Docker命令帮助:\n"
+    "  run        运行容器\n"
+    "  start      启动容器\n"
+    "  stop       停止容器\n"
+    "  restart    重启容器\n"
+    "  ps         列出容器\n"
+    "  logs       查看容器日志\n"
+    "  attach     附加到容器\n"
+    "  exec       在容器中执行命令\n"
+    "  rm         删除容器\n"
+    "  pull       拉取镜像\n"
+    "  images     列出镜像\n"
+    "  rmi        删除镜像\n"
+    "  login      登录到Registry\n"
+    "  build      构建镜像\n"
+    "  save       保存镜像\n"
+    "  load       加载镜像\n"
+    "  tag        为镜像添加标签\n"
+    "  inspect    检查容器或镜像\n"
+    "  top        显示容器进程\n"
+    "  stats      显示容器统计\n"
+    "  cp         复制文件\n"
+    "  diff       显示文件系统变更\n"
+    "  commit     从容器创建镜像\n"
+    "  export     导出容器\n"
+    "  import     导入镜像\n"
+    "  history    显示镜像历史\n"
+    "  info       显示系统信息\n"
+    "  version    显示版本信息\n"
+    "  help       显示此帮助信息\n"
+    "  network    网络管理\n"
+    "  volume     卷管理\n"
+    "  system     系统管理\n"
+    "  batch      在同一进程中依次执行多条命令\n"
+)
+
+# batch命令在每条命令的输出之后打印的分隔行，后跟该命令的退出状态
+BATCH_SEPARATOR = '---SEP---'
+
+
 class DockerCLI:
     """Docker风格的命令行接口"""
+
+    # 每个镜像一把锁，并发启动的容器使用同一镜像时只拉取一次
+    _image_locks = {}
+    _image_locks_guard = threading.Lock()
     
     def __init__(self, cache_dir=None):
         self.cache_dir = cache_dir or self._get_default_cache_dir()
@@ -62,11 +122,49 @@ class DockerCLI:
     def _save_containers(self, containers):
         """保存容器信息"""
         try:
-            with open(self.containers_file, 'w') as f:
+            # 先写临时文件再原子替换，并发读取时不会读到写了一半的文件
+            tmp_file = f"{self.containers_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w') as f:
                 json.dump(containers, f, indent=2)
+            os.replace(tmp_file, self.containers_file)
         except Exception as e:
             logger.error(f"保存容器信息失败: {e}")
 
+    def _image_lock(self, image_url):
+        """返回镜像对应的锁，不同镜像的拉取互不阻塞"""
+        with self._image_locks_guard:
+            return self._image_locks.setdefault(image_url, threading.Lock())
+
+    @contextlib.contextmanager
+    def _locked_containers(self):
+        """在containers.json旁的文件锁内读取容器信息，正常退出时保存修改
+
+        flock对每次open得到的文件描述独立加锁，线程之间、进程之间以及守护进程的各个请求之间都互斥
+        """
+        with open(self.containers_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            containers = self._load_containers()
+            yield containers
+            self._save_containers(containers)
+
+    def _update_container(self, container_id, container_info):
+        """基于最新的容器信息只更新单个容器，避免并发操作相互覆盖"""
+        with self._locked_containers() as containers:
+            containers[container_id] = container_info
+
+    def _patch_container(self, container_id, **fields):
+        """只修改单个容器记录中的字段，记录已被其他操作删除时返回False"""
+        with self._locked_containers() as containers:
+            if container_id not in containers:
+                return False
+            containers[container_id].update(fields)
+            return True
+
+    def _remove_container(self, container_id):
+        """基于最新的容器信息删除单个容器记录"""
+        with self._locked_containers() as containers:
+            containers.pop(container_id, None)
+
     def _load_config(self):
         """加载配置信息，包括认证凭证"""
         if os.path.exists(self.config_file):
@@ -139,18 +237,6 @@ class DockerCLI:
         if not quiet:
             logger.info(f"拉取镜像: {image_url}")
 
-        # 检查是否已缓存
-        if not force and self.runner._is_image_cached(image_url):
-            cache_info = self.runner._load_cache_info(image_url)
-            if cache_info:
-                if not quiet:
-                    logger.info(f"镜像已存在于缓存中")
-                    logger.info(f"缓存时间: {cache_info.get('created_time_str', 'Unknown')}")
-                else:
-                    # 在quiet模式下，只输出镜像ID或名称
-                    print(image_url)
-                return True
-
         # 加载凭证
         config = self._load_config()
         auths = config.get('auths', {})
@@ -163,27 +249,36 @@ class DockerCLI:
             if server_name in image_url or (server_name == "index.docker.io" and '/' not in image_url.split(':')[0]):
                 username = creds.get('username')
                 password = creds.get('password')
-                logger.info(f"找到 {server} 的凭证")
+                if not quiet:
+                    logger.info(f"找到 {server} 的凭证")
                 break
-        
-        # 现在pull直接调用runner的下载方法
-        if quiet:
-            # 在quiet模式下，临时抑制日志输出
-            original_level = logging.getLogger().level
-            logging.getLogger().setLevel(logging.ERROR)
-            
-        try:
-            cache_path = self.runner._download_image(
-                image_url,
-                force_download=force,
-                username=username,
-                password=password,
-                quiet=quiet
-            )
-        finally:
-            if quiet:
-                # 恢复原始日志级别
-                logging.getLogger().setLevel(original_level)
+
+        # quiet模式通过参数逐层传递，不修改全局日志级别：
+        # batch和守护进程中同一进程的其他线程可能正在执行别的命令
+        # 每次pull只用一个HEAD请求查询标签当前的manifest摘要：已缓存时据此判断是否需要重新下载，
+        # 下载时随缓存信息一起记录
+        remote_digest = self.runner._get_remote_digest(image_url, username, password)
+        if not force and self.runner._is_image_cached(image_url):
+            cache_info = self.runner._load_cache_info(image_url)
+            if cache_info:
+                if self.runner._is_cache_current(cache_info, remote_digest, quiet=quiet):
+                    if not quiet:
+                        logger.info(f"镜像已存在于缓存中")
+                        logger.info(f"缓存时间: {cache_info.get('created_time_str', 'Unknown')}")
+                    else:
+                        # 在quiet模式下，只输出镜像ID或名称
+                        print(image_url)
+                    return True
+                force = True
+
+        cache_path = self.runner._download_image(
+            image_url,
+            force_download=force,
+            username=username,
+            password=password,
+            quiet=quiet,
+            manifest_digest=remote_digest
+        )
 
         if cache_path:
             if not quiet:
@@ -199,13 +294,14 @@ class DockerCLI:
             
     def run(self, image_url, command=None, name=None, **kwargs):
         """运行容器"""
-        # 确保在运行前镜像存在
-        if not self.runner._is_image_cached(image_url) or kwargs.get('force_download', False):
-            logger.info(f"镜像不存在或需要强制下载，执行 'pull' 操作...")
-            pull_success = self.pull(image_url, force=kwargs.get('force_download', False), quiet=False)
-            if not pull_success:
-                logger.error(f"无法运行容器，因为镜像拉取失败: {image_url}")
-                return None
+        # 确保在运行前镜像存在；并发运行的其他容器正在拉取同一镜像时等待其完成
+        with self._image_lock(image_url):
+            if not self.runner._is_image_cached(image_url) or kwargs.get('force_download', False):
+                logger.info(f"镜像不存在或需要强制下载，执行 'pull' 操作...")
+                pull_success = self.pull(image_url, force=kwargs.get('force_download', False), quiet=False)
+                if not pull_success:
+                    logger.error(f"无法运行容器，因为镜像拉取失败: {image_url}")
+                    return None
 
         container_id = name if name else self._generate_container_id()
         container_dir = self._get_container_dir(container_id)
@@ -234,7 +330,6 @@ class DockerCLI:
         args = Args()
         
         # 记录容器信息
-        containers = self._load_containers()
         container_info = {
             'id': container_id,
             'image': image_url,
@@ -253,8 +348,7 @@ class DockerCLI:
             }
         }
         
-        containers[container_id] = container_info
-        self._save_containers(containers)
+        self._update_container(container_id, container_info)
 
         logger.info(f"启动容器: {container_id}")
         
@@ -264,25 +358,17 @@ class DockerCLI:
                 success = self._run_detached(image_url, args, container_id, container_dir)
             else:
                 # For foreground mode, ProotRunner handles the temporary rootfs.
-                container_info['status'] = 'running'
-                containers[container_id] = container_info
-                self._save_containers(containers)
+                self._patch_container(container_id, status='running')
                 
                 # We pass None for rootfs_dir so ProotRunner creates a temporary one
                 success = self.runner.run(image_url, args, rootfs_dir=None)
                 
-                # Update status after completion
-                container_info['status'] = 'exited'
-                container_info['finished'] = time.time()
-                container_info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                containers[container_id] = container_info
                 # In foreground mode, the temporary rootfs is cleaned up by ProotRunner,
                 # so we can remove the persistent container dir.
                 if os.path.exists(container_dir):
                     import shutil
                     shutil.rmtree(container_dir)
-                del containers[container_id]
-                self._save_containers(containers)
+                self._remove_container(container_id)
                 
             if success:
                 if args.detach:
@@ -291,15 +377,11 @@ class DockerCLI:
                     logger.info(f"容器 {container_id} 运行完成")
                 return container_id
             else:
-                container_info['status'] = 'failed'
-                containers[container_id] = container_info
-                self._save_containers(containers)
+                self._patch_container(container_id, status='failed')
                 return None
                 
         except KeyboardInterrupt:
-            container_info['status'] = 'interrupted'
-            containers[container_id] = container_info
-            self._save_containers(containers)
+            self._patch_container(container_id, status='interrupted')
             logger.info(f"容器 {container_id} 被用户中断")
             return container_id
             
@@ -349,19 +431,25 @@ class DockerCLI:
             # 打开日志文件用于重定向输出
             with open(log_file, 'a') as lf:
                 lf.write(f"--- Starting container at {datetime.now()} ---\\n")
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=lf,
-                    stderr=lf,
-                    stdin=subprocess.DEVNULL,
-                    start_new_session=True
-                )
-            
-            # 等待pid文件被创建，最多等待5秒
+                lf.flush()
+                if not self._fork_runner(cmd[3:], lf.fileno()):
+                    process = subprocess.Popen(
+                        cmd,
+                        stdout=lf,
+                        stderr=lf,
+                        stdin=subprocess.DEVNULL,
+                        start_new_session=True
+                    )
+            
+            # 等待pid文件被创建，最多等待15秒；间隔从10ms开始翻倍，容器启动快时不必空等
             pid = None
-            # 延长等待时间至15秒 (30 * 0.5s)
-            for i in range(30):
-                time.sleep(0.5)
+            deadline = time.monotonic() + 15
+            delay = 0.01
+            for i in itertools.count():
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
                 if os.path.exists(pid_file):
                     with open(pid_file, 'r') as pf:
                         pid_str = pf.read().strip()
@@ -372,7 +460,7 @@ class DockerCLI:
                                 break
                             except ValueError:
                                 logger.debug(f"PID文件内容无效: '{pid_str}'，继续等待...")
-                logger.debug(f"等待PID文件... (尝试 {i+1}/30)")
+                logger.debug(f"等待PID文件... (尝试 {i+1})")
             
             if not pid:
                 logger.error("无法获取后台进程的PID，启动可能失败。")
@@ -380,10 +468,8 @@ class DockerCLI:
                 return False
 
             # 更新容器信息
-            containers = self._load_containers()
-            containers[container_id]['status'] = 'running'
-            containers[container_id]['pid'] = pid
-            self._save_containers(containers)
+            if not self._patch_container(container_id, status='running', pid=pid):
+                logger.warning(f"容器 {container_id} 的记录已被删除，无法记录PID {pid}")
             
             return True
             
@@ -393,6 +479,50 @@ class DockerCLI:
             return False
 
             
+    def _fork_runner(self, argv, log_fd):
+        """在当前进程中fork出后台runner，成功时返回True
+
+        当前进程已导入所有模块（在守护进程中更是常驻的），fork后直接调用proot_runner的main，
+        省去为每个容器启动新解释器和导入模块的开销。fork只在单线程时是安全的，
+        有其他线程或平台不支持fork时返回False，由调用方启动新进程。
+        两次fork使runner脱离当前进程，不会留下僵尸进程
+        """
+        if not hasattr(os, 'fork') or threading.active_count() > 1:
+            return False
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return True
+
+        code = 1
+        try:
+            os.setsid()
+            if os.fork():
+                code = 0
+            else:
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, 0)
+                os.dup2(log_fd, 1)
+                os.dup2(log_fd, 2)
+                # 关闭继承的其他描述符（如守护进程与客户端的连接），否则客户端要等容器退出才能读到EOF
+                os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+                try:
+                    proot_runner_main(argv)
+                    code = 0
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
     def _cleanup_stale_lock_files(self, rootfs_dir):
         """在重启前清理常见的陈旧锁文件或PID文件"""
         logger.debug(f"正在清理根文件系统中的陈旧锁文件: {rootfs_dir}")
@@ -403,15 +533,16 @@ class DockerCLI:
             full_dir_path = os.path.join(rootfs_dir, l_dir.lstrip('/'))
             if os.path.isdir(full_dir_path):
                 try:
-                    for filename in os.listdir(full_dir_path):
-                        if filename.endswith('.pid'):
-                            file_path = os.path.join(full_dir_path, filename)
-                            try:
-                                os.remove(file_path)
-                                logger.debug(f"已删除陈旧的PID文件: {file_path}")
-                                cleaned_files += 1
-                            except OSError as e:
-                                logger.warning(f"删除PID文件失败 {file_path}: {e}")
+                    # DirEntry.path已拼好完整路径，不必逐个os.path.join
+                    with os.scandir(full_dir_path) as it:
+                        pid_files = [entry.path for entry in it if entry.name.endswith('.pid')]
+                    for file_path in pid_files:
+                        try:
+                            os.remove(file_path)
+                            logger.debug(f"已删除陈旧的PID文件: {file_path}")
+                            cleaned_files += 1
+                        except OSError as e:
+                            logger.warning(f"删除PID文件失败 {file_path}: {e}")
                 except Exception as e:
                     logger.warning(f"扫描目录失败 {full_dir_path}: {e}")
         
@@ -488,18 +619,11 @@ class DockerCLI:
             return success
         else:
             # Foreground restart logic remains the same
-            container_info['status'] = 'running'
-            containers[container_id] = container_info
-            self._save_containers(containers)
+            self._patch_container(container_id, status='running')
             success = self.runner.run(image_url, args, rootfs_dir=rootfs_dir)
             
-            containers = self._load_containers()
-            container_info = containers.get(container_id, {})
-            container_info['status'] = 'exited'
-            container_info['finished'] = time.time()
-            container_info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            containers[container_id] = container_info
-            self._save_containers(containers)
+            self._patch_container(container_id, status='exited', finished=time.time(),
+                                  finished_str=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
             return success
 
     def restart(self, container_id):
@@ -630,14 +754,13 @@ class DockerCLI:
 
         # If no command provided, use default shell
         if not command:
-            # Find available shell
-            default_shells = ['/bin/bash', '/bin/sh']
-            shell = '/bin/sh'  # default fallback
-            for s in default_shells:
-                shell_path = os.path.join(rootfs_dir, s.lstrip('/'))
-                if os.path.exists(shell_path):
-                    shell = s
-                    break
+            # Find available shell: 读一次rootfs的/bin目录，用名字判断，不逐个stat
+            try:
+                with os.scandir(os.path.join(rootfs_dir, 'bin')) as it:
+                    bin_names = {entry.name for entry in it}
+            except OSError:
+                bin_names = set()
+            shell = '/bin/bash' if 'bash' in bin_names else '/bin/sh'  # /bin/sh as default fallback
             command = [shell]
         elif isinstance(command, str):
             # If command is a string, convert it to a list
@@ -679,29 +802,25 @@ class DockerCLI:
 
     def ps(self, all_containers=False):
         """列出容器"""
-        containers = self._load_containers()
-        
+        with self._locked_containers() as containers:
+            # 更新运行中容器的状态
+            for container_id, info in containers.items():
+                if info.get('status') == 'running' and info.get('pid'):
+                    # 对于通过新方法启动的容器，pid是proot进程的真实pid
+                    if not self._is_process_running(info['pid']):
+                        info['status'] = 'exited'
+                        info['finished'] = time.time()
+                        info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                elif info.get('status') == 'running' and info.get('script_path'):
+                     # 兼容旧的、通过wrapper script启动的容器
+                    if not self._is_process_running(info['pid']):
+                        info['status'] = 'exited'
+                        info['finished'] = time.time()
+                        info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
         if not containers:
             logger.info("没有容器")
             return
-            
-        # 更新运行中容器的状态
-        for container_id, info in containers.items():
-            if info.get('status') == 'running' and info.get('pid'):
-                # 对于通过新方法启动的容器，pid是proot进程的真实pid
-                if not self._is_process_running(info['pid']):
-                    info['status'] = 'exited'
-                    info['finished'] = time.time()
-                    info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            elif info.get('status') == 'running' and info.get('script_path'):
-                 # 兼容旧的、通过wrapper script启动的容器
-                if not self._is_process_running(info['pid']):
-                    info['status'] = 'exited'
-                    info['finished'] = time.time()
-                    info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        
-        self._save_containers(containers)
         
         # 过滤容器
         if not all_containers:
@@ -712,9 +831,11 @@ class DockerCLI:
             logger.info("没有运行中的容器")
             return
             
-        # 显示容器列表
-        print(f"{'CONTAINER ID':<12} {'IMAGE':<30} {'COMMAND':<20} {'CREATED':<20} {'STATUS':<10}")
-        print("-" * 100)
+        # 显示容器列表，拼接后一次性写入stdout
+        lines = [
+            f"{'CONTAINER ID':<12} {'IMAGE':<30} {'COMMAND':<20} {'CREATED':<20} {'STATUS':<10}",
+            "-" * 100,
+        ]
         
         for container_id, info in containers.items():
             image = info.get('image', 'unknown')[:28]
@@ -722,7 +843,9 @@ class DockerCLI:
             created = info.get('created_str', 'unknown')
             status = info.get('status', 'unknown')
             
-            print(f"{container_id:<12} {image:<30} {command:<20} {created:<20} {status:<10}")
+            lines.append(f"{container_id:<12} {image:<30} {command:<20} {created:<20} {status:<10}")
+        
+        sys.stdout.write('\n'.join(lines) + '\n')
             
     def images(self):
         """列出镜像"""
@@ -752,10 +875,8 @@ class DockerCLI:
         
         if pid and not self._is_process_running(pid):
             logger.info(f"容器 {container_id} 进程已停止，更新状态为 'exited'")
-            container_info['status'] = 'exited'
-            container_info['finished'] = time.time()
-            container_info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self._save_containers(containers)
+            self._patch_container(container_id, status='exited', finished=time.time(),
+                                  finished_str=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
             return True
 
         # 如果没有PID，或者PID对应的进程没有运行，并且容器状态不是运行中，则直接认为已停止
@@ -764,10 +885,8 @@ class DockerCLI:
                 logger.info(f"容器 {container_id} 已经停止或处于非运行状态 ({container_info.get('status')}).")
                 # 确保状态被正确更新，即使PID缺失
                 if container_info.get('status') != 'exited':
-                    container_info['status'] = 'exited'
-                    container_info['finished'] = time.time()
-                    container_info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    self._save_containers(containers)
+                    self._patch_container(container_id, status='exited', finished=time.time(),
+                                          finished_str=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
                 return True
             else:
                 logger.warning(f"容器 {container_id} 没有有效的PID信息或进程未运行，但状态为 {container_info.get('status')}. 尝试强制停止.")
@@ -775,10 +894,9 @@ class DockerCLI:
                 # 这部分逻辑需要非常小心，以避免误删数据
                 # 对于docker-compose down场景，如果stop失败，rm会接管清理工作
                 # 所以这里主要目的是让stop返回True，让rm可以继续执行
-                container_info['status'] = 'exited' # 强制标记为已退出，以便rm可以处理
-                container_info['finished'] = time.time()
-                container_info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                self._save_containers(containers)
+                # 强制标记为已退出，以便rm可以处理
+                self._patch_container(container_id, status='exited', finished=time.time(),
+                                      finished_str=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
                 return True
             
         try:
@@ -789,19 +907,14 @@ class DockerCLI:
             # 等待一段时间后检查是否停止
             time.sleep(2)
             if not self._is_process_running(pid):
-                container_info['status'] = 'exited'
-                container_info['finished'] = time.time()
-                container_info['finished_str'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                containers[container_id] = container_info
-                self._save_containers(containers)
+                self._patch_container(container_id, status='exited', finished=time.time(),
+                                      finished_str=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
                 logger.info(f"容器 {container_id} 已停止")
                 return True
             else:
                 logger.warning(f"容器 {container_id} 未响应SIGTERM，尝试SIGKILL")
                 os.killpg(pid, signal.SIGKILL)
-                container_info['status'] = 'killed'
-                containers[container_id] = container_info
-                self._save_containers(containers)
+                self._patch_container(container_id, status='killed')
                 return True
                 
         except (OSError, ProcessLookupError) as e:
@@ -866,9 +979,7 @@ class DockerCLI:
                 pass
                 
         # 删除容器记录
-        if container_id in containers:
-            del containers[container_id]
-            self._save_containers(containers)
+        self._remove_container(container_id)
         
         logger.info(f"容器 {container_id} 已删除")
         return True
@@ -993,14 +1104,12 @@ class DockerCLI:
                 import shutil
                 shutil.copy2(source_cache_path, target_cache_path)
                 
-                # 复制info文件（如果存在）
-                source_info_path = source_cache_path + '.info'
-                target_info_path = target_cache_path + '.info'
-                if os.path.exists(source_info_path):
-                    shutil.copy2(source_info_path, target_info_path)
+                # 新标签指向同一镜像，沿用源镜像的manifest摘要，否则pull时会被当作过期重新下载
+                source_info = self.runner._load_cache_info(source_image) or {}
                 
                 # 保存新的缓存信息
-                self.runner._save_cache_info(target_image, target_cache_path)
+                self.runner._save_cache_info(target_image, target_cache_path,
+                                             source_info.get('manifest_digest'))
                 
                 logger.info(f"标签添加成功: {target_image}")
                 return True
@@ -1029,7 +1138,7 @@ class DockerCLI:
                     'Id': target,
                     'RepoTags': [target],
                     'Created': datetime.fromtimestamp(os.path.getctime(image_dir)).isoformat(),
-                    'Size': self._get_dir_size(image_dir),
+                    'Size': self._get_dir_size(image_dir, _get_size_prune_names()),
                     'Architecture': 'unknown',
                     'Os': 'linux'
                 }
@@ -1285,22 +1394,31 @@ class DockerCLI:
         logger.info("显示系统信息")
         try:
             import platform
-            import psutil
+            
+            # psutil为可选依赖，先用find_spec探测，缺失时不导入也不报错
+            total_memory = available_memory = 'N/A'
+            if importlib.util.find_spec('psutil') is not None:
+                import psutil
+                memory = psutil.virtual_memory()
+                total_memory = f"{memory.total / (1024**3):.2f} GB"
+                available_memory = f"{memory.available / (1024**3):.2f} GB"
+            
+            with os.scandir(os.path.join(self.cache_dir, 'images')) as it:
+                image_count = sum(1 for entry in it if entry.is_dir())
             
             info = {
                 'Containers': len(self._load_containers()),
-                'Images': len([d for d in os.listdir(os.path.join(self.cache_dir, 'images')) if os.path.isdir(os.path.join(self.cache_dir, 'images', d))]),
+                'Images': image_count,
                 'System Time': datetime.now().isoformat(),
                 'Operating System': platform.system(),
                 'Architecture': platform.machine(),
                 'Kernel Version': platform.release(),
-                'Total Memory': f"{psutil.virtual_memory().total / (1024**3):.2f} GB",
-                'Available Memory': f"{psutil.virtual_memory().available / (1024**3):.2f} GB",
+                'Total Memory': total_memory,
+                'Available Memory': available_memory,
                 'Cache Directory': self.cache_dir
             }
             
-            for key, value in info.items():
-                print(f"{key}: {value}")
+            sys.stdout.write(''.join(f"{key}: {value}\n" for key, value in info.items()))
             
             return True
         except Exception as e:
@@ -1322,8 +1440,7 @@ class DockerCLI:
                 'Experimental': 'false'
             }
             
-            for key, value in version_info.items():
-                print(f"{key}: {value}")
+            sys.stdout.write(''.join(f"{key}: {value}\n" for key, value in version_info.items()))
             
             return True
         except Exception as e:
@@ -1338,52 +1455,34 @@ class DockerCLI:
             print(f"docker {command} 命令的帮助信息")
         else:
             logger.info("显示Docker帮助信息")
-            print("Docker命令帮助:")
-            print("  run        运行容器")
-            print("  start      启动容器")
-            print("  stop       停止容器")
-            print("  restart    重启容器")
-            print("  ps         列出容器")
-            print("  logs       查看容器日志")
-            print("  attach     附加到容器")
-            print("  exec       在容器中执行命令")
-            print("  rm         删除容器")
-            print("  pull       拉取镜像")
-            print("  images     列出镜像")
-            print("  rmi        删除镜像")
-            print("  login      登录到Registry")
-            print("  build      构建镜像")
-            print("  save       保存镜像")
-            print("  load       加载镜像")
-            print("  tag        为镜像添加标签")
-            print("  inspect    检查容器或镜像")
-            print("  top        显示容器进程")
-            print("  stats      显示容器统计")
-            print("  cp         复制文件")
-            print("  diff       显示文件系统变更")
-            print("  commit     从容器创建镜像")
-            print("  export     导出容器")
-            print("  import     导入镜像")
-            print("  history    显示镜像历史")
-            print("  info       显示系统信息")
-            print("  version    显示版本信息")
-            print("  help       显示此帮助信息")
-            print("  network    网络管理")
-            print("  volume     卷管理")
-            print("  system     系统管理")
+            sys.stdout.write(_HELP_TEXT)
         return True
 
-    def _get_dir_size(self, path):
-        """获取目录大小"""
-        total_size = 0
+    def _iter_files(self, path, prune=frozenset()):
+        """递归遍历目录下的普通文件，返回os.DirEntry，跳过符号链接和prune中的目录"""
+        skip_hidden = '.*' in prune
         try:
-            for dirpath, dirnames, filenames in os.walk(path):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    if os.path.exists(filepath):
-                        total_size += os.path.getsize(filepath)
-        except Exception:
-            pass
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name in prune or (skip_hidden and entry.name.startswith('.')):
+                            continue
+                        yield from self._iter_files(entry.path, prune)
+                    else:
+                        yield entry
+        except OSError:
+            return
+
+    def _get_dir_size(self, path, prune=frozenset()):
+        """获取目录下所有普通文件的总大小，不计入prune中的目录"""
+        total_size = 0
+        for entry in self._iter_files(path, prune):
+            try:
+                total_size += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
         return total_size
 
     def network_create(self, name, driver="bridge"):
@@ -1576,14 +1675,12 @@ class DockerCLI:
             cleaned = 0
             
             # 清理停止的容器
-            containers = self._load_containers()
-            for container_id, container in list(containers.items()):
-                if not self._is_process_running(container.get('pid', 0)):
-                    logger.info(f"清理停止的容器: {container_id}")
-                    del containers[container_id]
-                    cleaned += 1
-            
-            self._save_containers(containers)
+            with self._locked_containers() as containers:
+                for container_id, container in list(containers.items()):
+                    if not self._is_process_running(container.get('pid', 0)):
+                        logger.info(f"清理停止的容器: {container_id}")
+                        del containers[container_id]
+                        cleaned += 1
             
             # 清理未使用的镜像（可选）
             if all_resources:
@@ -1892,12 +1989,44 @@ def create_parser():
     system_prune_parser = system_subparsers.add_parser('prune', help='清理未使用的资源')
     system_prune_parser.add_argument('-a', '--all', action='store_true', help='清理所有未使用的资源')
 
+    # batch 命令
+    batch_parser = subparsers.add_parser('batch', help='在同一进程中依次执行多条命令')
+    batch_parser.add_argument('file', nargs='?', default='-', help='每行一条命令的文件，默认从标准输入读取')
+
     return parser
 
-def main():
+def _run_batch(args):
+    """逐行读取命令并在本进程中依次执行，省去每条命令启动解释器和导入模块的开销
+
+    每条命令执行完后打印 BATCH_SEPARATOR 和退出状态；有命令失败时返回1
+    """
+    prefix = []
+    if args.cache_dir:
+        prefix += ['--cache-dir', args.cache_dir]
+    if args.verbose:
+        prefix.append('--verbose')
+
+    failed = 0
+    with (open(args.file) if args.file != '-' else contextlib.nullcontext(sys.stdin)) as stream:
+        for line in stream:
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            try:
+                main(prefix + argv)
+                status = 0
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else int(e.code is not None)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            print(f"{BATCH_SEPARATOR} {status}", flush=True)
+            failed += status != 0
+    return 1 if failed else 0
+
+def main(argv=None):
     """主函数"""
     parser = create_parser()
-    args, unknown = parser.parse_known_args()
+    args, unknown = parser.parse_known_args(argv)
 
     # Handle the command part for 'run' and 'exec'
     if args.subcommand in ['run', 'exec']:
@@ -1918,6 +2047,9 @@ def main():
         parser.print_help()
         return
 
+    if args.subcommand == 'batch':
+        sys.exit(_run_batch(args))
+
     # 创建CLI实例
     cli = DockerCLI(cache_dir=args.cache_dir)
 
@@ -3,40 +3,163 @@
 import argparse
 import subprocess
 import os
-import yaml
 import shlex
 import sys
 import time
 import logging
+import json
+import functools
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def run_docker_cli_command(command, args, cache_dir=None, detach=False):
-    # 直接通过模块化方式调用 docker_cli
-    base_cmd = [sys.executable, '-m', 'android_docker.docker_cli']
-    if cache_dir:
-        base_cmd.extend(['--cache-dir', cache_dir])
-    cmd = base_cmd + [command] + args
-    logger.info(f"Executing: {' '.join(cmd)}")
+# 在同一个子进程中执行多条 docker_cli 命令，只启动一次解释器并导入一次模块
+# 以JSON形式从stdin读入阶段列表，任一命令失败时以非零状态退出
+_BATCH_BOOTSTRAP = """
+import sys, json
+from android_docker.cli_daemon import run_stages
+sys.exit(1 if run_stages(json.load(sys.stdin)) else 0)
+"""
+
+# Python创建的文件描述符默认不可继承(PEP 446)，关闭close_fds后
+# subprocess可以走posix_spawn，避免fork复制父进程的页表
+_SPAWN_KWARGS = {'close_fds': False}
+
+# 已解析的compose文件，键为 (路径, mtime_ns, 大小)
+_COMPOSE_CACHE = {}
+
+def run_docker_cli_commands(stages, cache_dir=None, detach=False, use_daemon=False):
+    """在单个子进程中批量执行命令
+
+    stages为阶段列表，每个阶段是 [(command, args), ...]；阶段按顺序执行，
+    同一阶段内的命令并发执行。use_daemon为True时优先交给常驻的docker_cli
+    守护进程执行，此时同步等待命令完成
+    """
+    base_args = ['--cache-dir', cache_dir] if cache_dir else []
+    batch = [[base_args + [command] + args for command, args in stage] for stage in stages]
+    for stage in batch:
+        for argv in stage:
+            logger.info(f"Executing: {' '.join(argv)}")
+    if use_daemon and os.environ.get('ANDROID_DOCKER_DAEMON', '1') != '0':
+        # 按需导入，--help和参数错误时不加载docker_cli及其依赖
+        from .cli_daemon import send_stages
+        try:
+            status = send_stages(batch)
+        except (OSError, ValueError, KeyError) as e:
+            # 连接失败或回复无法解析（如守护进程中途退出）时都改用子进程执行
+            logger.debug(f"docker_cli守护进程不可用，改用子进程执行: {e}")
+        else:
+            if status != 0:
+                logger.error(f"Command failed: docker_cli daemon exited with status {status}")
+                sys.exit(1)
+            return None
+    cmd = [sys.executable, '-c', _BATCH_BOOTSTRAP]
+    payload = json.dumps(batch)
     try:
         if detach:
-            # 使用 Popen 启动后台进程，不等待其完成
-            subprocess.Popen(cmd)
+            # 后台模式下不等待批处理完成
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, text=True, **_SPAWN_KWARGS)
+            process.stdin.write(payload)
+            process.stdin.close()
+            return process
         else:
-            # 使用 run 等待前台进程完成
-            subprocess.run(cmd, check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            subprocess.run(cmd, input=payload, text=True, check=True, **_SPAWN_KWARGS)
+            return None
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Command failed: docker_cli batch exited with status {e.returncode}")
+        sys.exit(1)
+    except FileNotFoundError as e:
         logger.error(f"Command failed: {e}")
         sys.exit(1)
 
+def _load_container(containers_file, container_name):
+    """直接读取docker_cli的containers.json，文件不存在或无法解析时返回None
+
+    docker_cli以原子替换的方式写入该文件，不会读到写了一半的内容
+    """
+    try:
+        with open(containers_file) as f:
+            return json.load(f).get(container_name)
+    except (OSError, ValueError):
+        return None
+
+def wait_ready(container_name, cache_dir=None, process=None, timeout=15.0):
+    """以指数退避轮询容器状态，直到容器进入running或启动失败
+
+    process为执行启动命令的批处理子进程，它退出后不再继续等待
+    """
+    # 与docker_cli的默认缓存目录一致
+    cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.docker_proot_cache')
+    containers_file = os.path.join(cache_dir, 'containers.json')
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while True:
+        batch_finished = process is not None and process.poll() is not None
+        info = _load_container(containers_file, container_name)
+        if info and info.get('status') != 'created':
+            return info.get('status') == 'running'
+        if batch_finished or time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
 def parse_compose_file(file_path="docker-compose.yml"):
     if not os.path.exists(file_path):
         logger.error(f"Compose file not found: {file_path}")
         sys.exit(1)
-    with open(file_path, 'r') as f:
-        return yaml.safe_load(f)
+    st = os.stat(file_path)
+    key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+    if key not in _COMPOSE_CACHE:
+        with open(file_path, 'rb') as f:
+            _COMPOSE_CACHE[key] = _load_services(f, file_path)
+    return _COMPOSE_CACHE[key]
+
+def _load_services(stream, file_path):
+    """只构造compose文件中的services部分
+
+    先得到节点树并检查结构，services不是映射时立即报错退出；
+    其余顶层键（volumes、networks、x-扩展等）不会被构造成Python对象
+    """
+    # yaml只在解析compose文件时才需要，延迟导入以加快--help等命令的启动
+    import yaml
+    try:
+        # 优先使用libyaml的C实现
+        from yaml import CSafeLoader as Loader
+    except ImportError:
+        from yaml import SafeLoader as Loader
+
+    loader = Loader(stream)
+    try:
+        root = loader.get_single_node()
+        if root is None:
+            return None
+        if not isinstance(root, yaml.MappingNode):
+            logger.error(f"Invalid compose file {file_path}: top level must be a mapping")
+            sys.exit(1)
+        for key_node, value_node in root.value:
+            if key_node.value != 'services':
+                continue
+            if isinstance(value_node, yaml.ScalarNode) and value_node.tag == 'tag:yaml.org,2002:null':
+                return {}
+            if not isinstance(value_node, yaml.MappingNode):
+                logger.error(f"Invalid compose file {file_path}: 'services' must be a mapping")
+                sys.exit(1)
+            return {'services': loader.construct_document(value_node)}
+        return {}
+    finally:
+        loader.dispose()
+
+# 相同的command字符串只切分一次；返回的列表被共享，调用方不可修改
+_split_command = functools.lru_cache(maxsize=None)(shlex.split)
+
+def resolve_services(compose_config):
+    """返回 [(服务名, 服务配置, 容器名), ...]，项目名只计算一次"""
+    project_name = os.path.basename(os.getcwd()) # Use current directory name as project name
+    return [
+        (service_name, service_config, service_config.get('container_name') or f"{project_name}-{service_name}")
+        for service_name, service_config in compose_config['services'].items()
+    ]
 
 def cmd_up(args):
     compose_config = parse_compose_file(args.file)
@@ -44,25 +167,38 @@ def cmd_up(args):
         logger.error("No services defined in compose file.")
         sys.exit(1)
 
-    project_name = os.path.basename(os.getcwd()) # Use current directory name as project name
-
-    for service_name, service_config in compose_config['services'].items():
-        image = service_config.get('image')
-        container_name = service_config.get('container_name', f"{project_name}-{service_name}")
-        command = service_config.get('command')
+    commands = []
+    container_names = []
+    for service_name, service_config, container_name in resolve_services(compose_config):
+        get = service_config.get
+        image, command = get('image'), get('command')
 
         if not image:
             logger.error(f"Service '{service_name}' is missing an image.")
             continue
 
         logger.info(f"Starting service: {service_name} (Container: {container_name})")
-        run_docker_cli_command(
+        container_names.append(container_name)
+        commands.append((
             'run',
-            (['-d'] if args.detach else []) + ['--name', container_name, image] + (['--'] + shlex.split(command) if command else []),
-            cache_dir=args.cache_dir,
-            detach=args.detach
-        )
-        time.sleep(1) # Add a short delay to avoid race conditions
+            (['-d'] if args.detach else []) + ['--name', container_name, image] + (['--'] + _split_command(command) if command else [])
+        ))
+
+    # 后台模式下各服务相互独立，放在同一阶段中并发启动；前台模式的输出共用一个终端，
+    # 按原来的顺序逐个启动，且需要占用终端，不交给守护进程
+    stages = [commands] if args.detach else [[command] for command in commands]
+    process = run_docker_cli_commands(
+        stages,
+        cache_dir=args.cache_dir,
+        detach=args.detach,
+        use_daemon=args.detach,
+    )
+
+    # 前台模式下run本身会阻塞，只有后台模式需要等待容器就绪
+    if args.detach:
+        for container_name in container_names:
+            if not wait_ready(container_name, cache_dir=args.cache_dir, process=process):
+                logger.warning(f"Container {container_name} is not running yet")
 
 
 def cmd_down(args):
@@ -71,14 +207,16 @@ def cmd_down(args):
         logger.info("No services defined in compose file, nothing to stop/remove.")
         sys.exit(0)
 
-    project_name = os.path.basename(os.getcwd()) # Use current directory name as project name
-
-    for service_name, service_config in compose_config['services'].items():
-        container_name = service_config.get('container_name', f"{project_name}-{service_name}")
+    stop_commands = []
+    rm_commands = []
+    for service_name, _, container_name in resolve_services(compose_config):
         logger.info(f"Stopping service: {service_name} (Container: {container_name})")
-        run_docker_cli_command('stop', [container_name], cache_dir=args.cache_dir)
+        stop_commands.append(('stop', [container_name]))
         logger.info(f"Removing service: {service_name} (Container: {container_name})")
-        run_docker_cli_command('rm', [container_name], cache_dir=args.cache_dir)
+        rm_commands.append(('rm', [container_name]))
+
+    # 容器之间相互独立：先并发停止所有容器，全部停止后再并发删除
+    run_docker_cli_commands([stop_commands, rm_commands], cache_dir=args.cache_dir, use_daemon=True)
 
 def main():
     parser = argparse.ArgumentParser(
@@ -12,16 +12,311 @@ import argparse
 import json
 import tempfile
 import shutil
+import copy
 import logging
 import hashlib
 import shlex
 import time
-from pathlib import Path
+import re
+import signal
+import fcntl
+import functools
+import stat
+import tarfile
+import threading
+import contextlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson为可选依赖，可用时用它解析和生成缓存信息、镜像配置
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# isal为可选依赖，提供SIMD加速的gzip解压（igzip），没有时使用标准库
+try:
+    from isal import igzip as _gzip
+    from isal.isal_zlib import error as _InflateError
+except ImportError:
+    import gzip as _gzip
+    from zlib import error as _InflateError
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 镜像引用: [registry[:port]/]name[/name...][:tag][@digest]
+_IMAGE_URL_RE = re.compile(
+    r'^(?:docker://)?[\w.-]+(?::\d+)?(?:/[\w.-]+)*(?::[\w.-]+)?(?:@sha256:[0-9a-f]{64})?$'
+)
+
+# manifest摘要，用作解压缓存的目录名
+_DIGEST_RE = re.compile(r'^[a-z0-9]+:[0-9a-f]{32,}$')
+
+# 旧版本按tar包路径的sha256前16位命名的解压缓存及其标记文件
+_LEGACY_EXTRACTED_RE = re.compile(r'^[0-9a-f]{16}(?:\.|$)')
+
+# 解压后不超过该大小（MiB）的临时根文件系统优先放在内存文件系统中
+_DEFAULT_TMPFS_SIZE = 512
+
+# 下载与解压之间管道的缓冲区大小
+_PIPE_SIZE = 1024 * 1024
+
+# 用Python解压tar包时的读写缓冲区大小，以及交给线程池写出的文件大小上限
+_TAR_READ_BUFFER = 1024 * 1024
+_TAR_WRITE_BUFFER = 256 * 1024
+_TAR_ASYNC_LIMIT = 1024 * 1024
+# tarfile流式模式每读一个成员头都会复制剩余的解压缓冲区，块过大反而更慢
+_TAR_STREAM_BUFFER = 64 * 1024
+
+# 计算文件摘要时的读缓冲区大小
+_HASH_BUFFER = 1024 * 1024
+
+# 启动脚本中双引号内需要转义的字符
+_DQUOTE_ESCAPES = str.maketrans({c: '\\' + c for c in '\\"$`'})
+
+# 各运行模式下子进程的 (stdin, stdout, stderr)
+# 'null'重定向到/dev/null，'log'重定向到日志文件（未指定时继承），None继承当前进程
+_STDIO_MODES = {
+    'detach': ('null', 'log', 'log'),
+    'interactive': (None, None, None),
+    'foreground': (None, 'log', 'log'),
+}
+
+# posix_spawnp需要Python 3.8+，部分Android/Bionic构建没有提供，此时退回subprocess
+_HAVE_POSIX_SPAWN = hasattr(os, 'posix_spawnp')
+
+# 退回subprocess启动的子进程，保留Popen对象直到被等待，避免其析构时抢先回收子进程
+_popen_children = {}
+
+# 已找到的命令，键为 (命令名, PATH)
+_executable_cache = {}
+
+# 本进程已清扫过的回收目录，多个ProotRunner实例只清扫一次
+_swept_trash_dirs = set()
+
+
+def spawn_process(cmd, env, stdio_fds=(None, None, None), new_session=False):
+    """启动子进程并返回PID，stdio_fds依次为标准输入、输出、错误的来源描述符，None表示继承
+
+    优先使用posix_spawnp，不支持时退回subprocess.Popen；两种方式都不关闭其他描述符
+    """
+    if _HAVE_POSIX_SPAWN:
+        file_actions = [(os.POSIX_SPAWN_DUP2, fd, target_fd)
+                        for target_fd, fd in enumerate(stdio_fds) if fd is not None]
+        try:
+            return os.posix_spawnp(cmd[0], cmd, env, file_actions=file_actions, setsid=new_session)
+        except NotImplementedError:
+            # 平台不支持POSIX_SPAWN_SETSID
+            pass
+
+    stdin, stdout, stderr = stdio_fds
+    proc = subprocess.Popen(cmd, env=env, stdin=stdin, stdout=stdout, stderr=stderr,
+                            start_new_session=new_session, close_fds=False)
+    _popen_children[proc.pid] = proc
+    return proc.pid
+
+
+def wait_process(pid):
+    """等待spawn_process启动的子进程结束，返回waitpid的结果"""
+    try:
+        return os.waitpid(pid, 0)
+    finally:
+        _popen_children.pop(pid, None)
+
+
+def _find_executable(name):
+    """在PATH中查找命令，找到的结果按 (命令名, PATH) 缓存
+
+    找不到时不缓存，用户安装后或换用其他PATH（如守护进程中的不同客户端）时重新查找
+    """
+    path = os.environ.get('PATH')
+    key = (name, path)
+    found = _executable_cache.get(key)
+    if found is None:
+        found = shutil.which(name, path=path)
+        if found is not None:
+            _executable_cache[key] = found
+    return found
+
+
+@functools.lru_cache(maxsize=None)
+def _default_bind_args(android):
+    """探测宿主机上存在的默认绑定挂载，返回展开后的proot参数 ('-b', 路径, ...)"""
+    default_binds = ['/dev', '/proc', '/sys']
+
+    # 在Android/Termux中添加额外的绑定
+    if android:
+        default_binds.extend([
+            '/sdcard',
+            '/system/etc/resolv.conf:/etc/resolv.conf'
+        ])
+
+    return tuple(
+        arg
+        for bind in default_binds if os.path.exists(bind.split(':', 1)[0])
+        for arg in ('-b', bind)
+    )
+
+
+def reset_host_probes():
+    """清空对宿主机命令和默认绑定路径的探测结果，常驻进程在每个请求开始时调用"""
+    _executable_cache.clear()
+    _default_bind_args.cache_clear()
+
+
+def _load_json(path):
+    """以二进制方式读取JSON文件，安装了orjson时由它解析"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dump_json(obj, path):
+    """把对象写成缩进2格的JSON文件，安装了orjson时由它生成"""
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(obj, indent=2).encode()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_image_config_cached(data):
+    """解析镜像配置文件的内容，结果在调用之间共享，不可修改"""
+    config_data = orjson.loads(data) if orjson is not None else json.loads(data)
+    config = config_data.get('config') or {}
+    env = tuple(tuple(env_str.split('=', 1)) for env_str in config.get('Env') or [] if '=' in env_str)
+    return config_data, env
+
+
+def _parse_image_config(data):
+    """解析镜像配置文件的内容，返回 (配置, 镜像的环境变量 ((键, 值), ...))
+
+    同一镜像启动的多个容器（compose、守护进程）配置内容相同，只解析一次；
+    每次返回配置的深拷贝，调用方修改后不会影响同一进程中之后的容器
+    """
+    config_data, env = _parse_image_config_cached(data)
+    return copy.deepcopy(config_data), env
+
+
+def _file_sha256(path):
+    """计算文件内容的sha256，Python 3.11+由hashlib.file_digest在C中循环读取"""
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        buf = bytearray(_HASH_BUFFER)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def _rootfs_filter(member, path):
+    """与GNU tar一致：拒绝解压到目标目录之外，但保留原始权限位（如/tmp的sticky位）"""
+    return tarfile.tar_filter(member, path).replace(mode=member.mode, deep=False)
+
+
+def _advise_sequential(fd):
+    """提示内核按顺序读取整个文件并立即开始预读，使磁盘读取与解压重叠；不支持时忽略"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+
+
+def _write_file(path, data, mode, mtime):
+    """写出一个文件，并通过文件描述符设置权限和修改时间"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if mode is not None:
+            os.fchmod(fd, mode)
+        if mtime is not None:
+            os.utime(fd, (mtime, mtime))
+    finally:
+        os.close(fd)
+
+
+class _RootfsTarFile(tarfile.TarFile):
+    """解压rootfs用的TarFile
+
+    小文件读入内存后交给线程池写出，使大量open/write/close在多个线程中并发执行；
+    权限和时间通过已打开的文件描述符设置，不再按路径重新解析
+    """
+
+    _writer = None
+    _pending = None
+    _fd_attrs_path = None
+
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None:
+            return super().makefile(tarinfo, targetpath)
+        self._wait_for(targetpath)
+        source = self.fileobj
+        source.seek(tarinfo.offset_data)
+        if self._writer is not None and tarinfo.size <= _TAR_ASYNC_LIMIT:
+            data = source.read(tarinfo.size)
+            if len(data) != tarinfo.size:
+                raise tarfile.ReadError("unexpected end of data")
+            self._pending[targetpath] = self._writer.submit(_write_file, targetpath, data, tarinfo.mode, tarinfo.mtime)
+        else:
+            with open(targetpath, 'wb', buffering=_TAR_WRITE_BUFFER) as target:
+                tarfile.copyfileobj(source, target, tarinfo.size, tarfile.ReadError, _TAR_WRITE_BUFFER)
+                target.flush()
+                fd = target.fileno()
+                if tarinfo.mode is not None:
+                    os.fchmod(fd, tarinfo.mode)
+                if tarinfo.mtime is not None:
+                    os.utime(fd, (tarinfo.mtime, tarinfo.mtime))
+        self._fd_attrs_path = targetpath
+
+    def makelink(self, tarinfo, targetpath):
+        # 硬链接的目标可能还在后台写出
+        if tarinfo.islnk():
+            self.drain()
+        else:
+            self._wait_for(targetpath)
+        super().makelink(tarinfo, targetpath)
+
+    def chmod(self, tarinfo, targetpath):
+        if targetpath != self._fd_attrs_path:
+            super().chmod(tarinfo, targetpath)
+
+    def utime(self, tarinfo, targetpath):
+        if targetpath != self._fd_attrs_path:
+            super().utime(tarinfo, targetpath)
+        self._fd_attrs_path = None
+
+    def _wait_for(self, targetpath):
+        """同一路径在归档中重复出现时，先等之前的写出完成"""
+        if self._pending:
+            future = self._pending.pop(targetpath, None)
+            if future is not None:
+                future.result()
+
+    def drain(self):
+        """等待所有后台写出完成，并抛出其中的错误"""
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.result()
+        self._fd_attrs_path = None
+
+
 class ProotRunner:
     """使用proot运行容器的类，支持一条龙服务"""
 
@@ -29,8 +324,15 @@ class ProotRunner:
         self.temp_dir = None
         self.rootfs_dir = None
         self.config_data = None
+        self._image_env = ()
+        self._android = None
+        # (rootfs_dir, rootfs/bin下的文件名)，同一根文件系统只读取一次
+        self._bin_names = None
         self.cache_dir = cache_dir or self._get_default_cache_dir()
         self._ensure_cache_dir()
+        # 默认绑定挂载的源路径在进程生命周期内不会变化，同一进程的所有实例共享探测结果
+        self._default_bind_args = _default_bind_args(self._is_android_environment())
+        self._sweep_trash()
 
     def _get_default_cache_dir(self):
         """获取默认缓存目录"""
@@ -65,51 +367,88 @@ class ProotRunner:
         cache_path = self._get_image_cache_path(image_url)
         return cache_path + '.info'
 
-    def _save_cache_info(self, image_url, cache_path):
-        """保存缓存信息"""
+    def _save_cache_info(self, image_url, cache_path, manifest_digest=None):
+        """保存缓存信息，同时记录tar包的sha256以及计算摘要时的大小和修改时间
+
+        manifest_digest为下载时标签指向的manifest摘要，用于判断远端镜像是否更新
+        """
         info = {
             'image_url': image_url,
             'cache_path': cache_path,
             'created_time': time.time(),
             'created_time_str': time.strftime('%Y-%m-%d %H:%M:%S')
         }
+        if manifest_digest:
+            info['manifest_digest'] = manifest_digest
+        # 标签指向了新的镜像时，旧镜像的解压缓存不会再用到
+        try:
+            old_digest = _load_json(self._get_cache_info_path(image_url)).get('manifest_digest')
+        except (OSError, ValueError):
+            old_digest = None
+        if old_digest and old_digest != manifest_digest:
+            self._discard_extracted_rootfs(old_digest)
+        try:
+            st = os.stat(cache_path)
+            info.update(sha256=_file_sha256(cache_path), size=st.st_size, mtime_ns=st.st_mtime_ns)
+        except OSError as e:
+            logger.warning(f"计算缓存摘要失败: {e}")
 
-        info_path = self._get_cache_info_path(image_url)
-        with open(info_path, 'w') as f:
-            json.dump(info, f, indent=2)
+        self._write_cache_info(image_url, info)
+
+    def _write_cache_info(self, image_url, info):
+        """写入缓存信息文件"""
+        _dump_json(info, self._get_cache_info_path(image_url))
 
     def _load_cache_info(self, image_url):
-        """加载缓存信息"""
+        """加载缓存信息
+
+        tar包的大小或修改时间与记录不一致时才重新计算sha256，摘要不符说明缓存已损坏，返回None
+        """
         info_path = self._get_cache_info_path(image_url)
         if os.path.exists(info_path):
             try:
-                with open(info_path, 'r') as f:
-                    return json.load(f)
+                info = _load_json(info_path)
             except Exception as e:
                 logger.warning(f"读取缓存信息失败: {e}")
+                return None
+            if not self._verify_cache(image_url, info):
+                return None
+            return info
         return None
 
-    def _download_image(self, image_url, force_download=False, username=None, password=None, quiet=False):
-        """下载镜像到缓存"""
+    def _verify_cache(self, image_url, info):
+        """校验缓存的tar包是否与记录的sha256一致，旧版本没有摘要的缓存视为有效"""
+        if 'sha256' not in info:
+            return True
         cache_path = self._get_image_cache_path(image_url)
+        try:
+            st = os.stat(cache_path)
+            if st.st_size == info.get('size') and st.st_mtime_ns == info.get('mtime_ns'):
+                return True
+            digest = _file_sha256(cache_path)
+        except OSError:
+            return False
+        if digest != info['sha256']:
+            logger.warning(f"缓存的镜像已损坏，需要重新下载: {cache_path}")
+            return False
+        # 内容未变（如被复制或touch过），更新记录以免下次再算
+        info.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+        try:
+            self._write_cache_info(image_url, info)
+        except OSError:
+            pass
+        return True
 
-        # 检查缓存
-        if not force_download and self._is_image_cached(image_url):
-            cache_info = self._load_cache_info(image_url)
-            if cache_info:
-                if not quiet:
-                    logger.info(f"使用缓存的镜像: {cache_path}")
-                    logger.info(f"缓存创建时间: {cache_info.get('created_time_str', 'Unknown')}")
-                return cache_path
-
-        if not quiet:
-            logger.info(f"下载镜像: {image_url}")
-
-        # 调用create_rootfs_tar.py脚本
+    def _build_download_command(self, image_url, output_path, username=None, password=None, quiet=False):
+        """构建调用create_rootfs_tar.py的命令，output_path为 - 时tar包写到标准输出"""
         cmd = [
             sys.executable,
             '-m', 'android_docker.create_rootfs_tar',
-            '-o', cache_path,
+            '-o', output_path,
+            # 所有层复用同一个curl进程的连接
+            '--max-conns', '6', '--keep-alive',
+            # 层并行下载，并与提取重叠进行
+            '--parallel', '4',
         ]
         if username:
             cmd.extend(['--username', username])
@@ -126,6 +465,52 @@ class ProotRunner:
             cmd.append('--quiet')
 
         cmd.append(image_url)
+        return cmd
+
+    def _get_remote_digest(self, image_url, username=None, password=None):
+        """用HEAD请求查询镜像标签当前指向的manifest摘要，失败时返回None"""
+        from .create_rootfs_tar import get_manifest_digest
+        return get_manifest_digest(image_url, username, password)
+
+    def _is_cache_current(self, cache_info, remote_digest, quiet=False):
+        """比较远端manifest摘要与缓存记录，判断缓存的镜像是否仍是最新
+
+        remote_digest为本次pull查询到的摘要，查询失败（如离线）时为None，沿用缓存；
+        旧版本的缓存没有记录摘要，无法比较，同样视为有效而不是重新下载
+        """
+        if remote_digest is None:
+            if not quiet:
+                logger.warning("无法查询远端镜像摘要，使用缓存的镜像")
+            return True
+        cached_digest = cache_info.get('manifest_digest')
+        if cached_digest is None or cached_digest == remote_digest:
+            return True
+        if not quiet:
+            logger.info(f"远端镜像已更新: {remote_digest}")
+        return False
+
+    def _download_image(self, image_url, force_download=False, username=None, password=None, quiet=False,
+                        manifest_digest=None):
+        """下载镜像到缓存
+
+        manifest_digest为调用方已查询到的标签摘要，随缓存信息一起记录，此处不再重复查询
+        """
+        cache_path = self._get_image_cache_path(image_url)
+
+        # 检查缓存
+        if not force_download and self._is_image_cached(image_url):
+            cache_info = self._load_cache_info(image_url)
+            if cache_info:
+                if not quiet:
+                    logger.info(f"使用缓存的镜像: {cache_path}")
+                    logger.info(f"缓存创建时间: {cache_info.get('created_time_str', 'Unknown')}")
+                return cache_path
+
+        if not quiet:
+            logger.info(f"下载镜像: {image_url}")
+
+        # 调用create_rootfs_tar.py脚本
+        cmd = self._build_download_command(image_url, cache_path, username, password, quiet)
 
         try:
             # 在quiet模式下抑制子进程输出
@@ -137,7 +522,7 @@ class ProotRunner:
                 logger.info(f"镜像已下载并缓存: {cache_path}")
 
             # 保存缓存信息
-            self._save_cache_info(image_url, cache_path)
+            self._save_cache_info(image_url, cache_path, manifest_digest)
 
             return cache_path
 
@@ -148,16 +533,11 @@ class ProotRunner:
 
     def _is_image_url(self, input_str):
         """判断输入是否为镜像URL"""
-        # 简单的启发式判断
-        url_indicators = [
-            '/' in input_str and ':' in input_str,  # 包含registry和tag
-            input_str.count('/') >= 1,  # 至少有一个斜杠
-            not input_str.endswith('.tar'),  # 不是tar文件
-            not input_str.endswith('.tar.gz'),  # 不是tar.gz文件
-            not os.path.exists(input_str)  # 不是本地文件/目录
-        ]
-
-        return any(url_indicators)
+        # tar文件和本地文件/目录不是镜像URL，存在性检查放在最后以减少stat调用；
+        # lexists不解析符号链接，本地路径即使是悬空链接也不会被当成镜像
+        return (not input_str.endswith(('.tar', '.tar.gz'))
+                and _IMAGE_URL_RE.match(input_str) is not None
+                and not os.path.lexists(input_str))
 
     def _prepare_rootfs(self, input_path, args, provided_rootfs_dir=None):
         """准备根文件系统（下载或使用现有）"""
@@ -173,61 +553,163 @@ class ProotRunner:
         if self._is_image_url(input_path):
             # 这是一个镜像URL，需要下载
             logger.info(f"检测到镜像URL: {input_path}")
+            force_download = getattr(args, 'force_download', False)
+            username = getattr(args, 'username', None)
+            password = getattr(args, 'password', None)
+            manifest_digest = None
+            if force_download or not (self._is_image_cached(input_path) and self._load_cache_info(input_path)):
+                # 记下标签当前指向的manifest摘要，之后pull时不必重新下载
+                manifest_digest = self._get_remote_digest(input_path, username, password)
+                if _find_executable('tee'):
+                    # 未缓存时边下载边解压，同时写入缓存
+                    return self._download_and_extract(
+                        input_path,
+                        username=username,
+                        password=password,
+                        provided_rootfs_dir=provided_rootfs_dir,
+                        manifest_digest=manifest_digest
+                    )
+                # 没有tee命令时先下载到缓存，再按缓存的tar包解压
             cache_path = self._download_image(
                 input_path,
-                force_download=getattr(args, 'force_download', False),
-                username=getattr(args, 'username', None),
-                password=getattr(args, 'password', None)
+                force_download=force_download,
+                username=username,
+                password=password,
+                manifest_digest=manifest_digest
             )
             if not cache_path:
                 return None
-            return self._extract_rootfs_if_needed(cache_path, provided_rootfs_dir=provided_rootfs_dir)
+            # 只有拉取的镜像使用解压缓存，按manifest摘要区分
+            cache_info = self._load_cache_info(input_path) or {}
+            return self._extract_rootfs_if_needed(
+                cache_path,
+                provided_rootfs_dir=provided_rootfs_dir,
+                tmpfs_size=getattr(args, 'tmpfs_size', _DEFAULT_TMPFS_SIZE),
+                manifest_digest=cache_info.get('manifest_digest')
+            )
         else:
             # 这是本地文件或目录
             logger.info(f"使用本地根文件系统: {input_path}")
-            return self._extract_rootfs_if_needed(input_path, provided_rootfs_dir=provided_rootfs_dir)
+            return self._extract_rootfs_if_needed(
+                input_path,
+                provided_rootfs_dir=provided_rootfs_dir,
+                tmpfs_size=getattr(args, 'tmpfs_size', _DEFAULT_TMPFS_SIZE)
+            )
         
-    def _check_dependencies(self):
-        """检查必要的依赖是否已安装"""
-        # 检查proot
+    def _set_pipe_size(self, pipe):
+        """增大管道缓冲区以减少读写系统调用次数，不支持时忽略"""
         try:
-            subprocess.run(['proot', '--version'],
-                         capture_output=True, check=True)
-            logger.info("✓ proot 已安装")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ proot 未安装")
-            logger.info("请安装proot: pkg install proot (Termux) 或 apt install proot")
-            return False
+            fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, _PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
 
-        # 检查create_rootfs_tar.py脚本
-        # Since we are using `python -m`, we don't need to check for the script path here.
-        # The python interpreter will find the module.
-        logger.info("✓ create_rootfs_tar.py module is available")
+    def _download_and_extract(self, image_url, username=None, password=None, provided_rootfs_dir=None,
+                              manifest_digest=None):
+        """下载镜像并直接解压到根文件系统目录
 
-        # 检查curl（create_rootfs_tar.py需要）
+        create_rootfs_tar.py把tar包写到标准输出，经tee写入缓存的同时由本进程解压并解包，
+        下载与解压重叠进行，且不必再从磁盘读一遍缓存的tar包。解包与_extract_rootfs_if_needed
+        使用同一套方法，失败时持久化目录中不会留下解压了一半的根文件系统
+        """
+        cache_path = self._get_image_cache_path(image_url)
+        part_path = cache_path + '.part'
+        is_temp = self._make_rootfs_dir(provided_rootfs_dir)
+
+        logger.info(f"下载镜像并解压: {image_url} -> {self.rootfs_dir}")
+        producer = subprocess.Popen(
+            self._build_download_command(image_url, '-', username, password),
+            stdout=subprocess.PIPE
+        )
+        self._set_pipe_size(producer.stdout)
+        tee = subprocess.Popen(['tee', part_path], stdin=producer.stdout, stdout=subprocess.PIPE)
+        self._set_pipe_size(tee.stdout)
+        # 只保留子进程持有的管道端，上游退出时下游才能读到EOF
+        producer.stdout.close()
+
+        error = None
         try:
-            subprocess.run(['curl', '--version'],
-                         capture_output=True, check=True)
-            logger.info("✓ curl 已安装")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ curl 未安装")
-            logger.info("请安装curl: pkg install curl (Termux) 或 apt install curl")
-            return False
+            # 解包提前失败时关闭读端，tee和create_rootfs_tar随之收到SIGPIPE退出
+            with tee.stdout:
+                self._fill_rootfs_dir(lambda target_dir: self._extract_tar_stream(tee.stdout, True, target_dir))
+        except (subprocess.CalledProcessError, tarfile.TarError, OSError) as e:
+            error = e
+        returncodes = [process.wait() for process in (producer, tee)]
+        if error or any(returncodes):
+            logger.error(f"下载或解压镜像失败 (退出码: create_rootfs_tar={returncodes[0]}, tee={returncodes[1]})")
+            if error:
+                logger.error(f"解压失败: {error}")
+            try:
+                os.remove(part_path)
+            except FileNotFoundError:
+                pass
+            if is_temp:
+                self._cleanup()
+            return None
 
-        # 检查tar
-        try:
-            subprocess.run(['tar', '--version'],
-                         capture_output=True, check=True)
-            logger.info("✓ tar 已安装")
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            logger.error("✗ tar 未安装")
-            logger.info("请安装tar: pkg install tar (Termux) 或 apt install tar")
+        os.replace(part_path, cache_path)
+        self._save_cache_info(image_url, cache_path, manifest_digest)
+        if manifest_digest:
+            # 这次下载就是镜像的第一次使用，再次使用时才解压到缓存
+            self._claim_first_use(manifest_digest)
+        logger.info(f"镜像已缓存: {cache_path}")
+        logger.info(f"根文件系统已解压到: {self.rootfs_dir}")
+        return self.rootfs_dir
+
+    def _needs_download(self, input_path, args, provided_rootfs_dir=None):
+        """判断_prepare_rootfs是否需要下载镜像"""
+        if provided_rootfs_dir and os.path.exists(provided_rootfs_dir) and os.listdir(provided_rootfs_dir):
             return False
+        if not self._is_image_url(input_path):
+            return False
+        return getattr(args, 'force_download', False) or not (
+            self._is_image_cached(input_path) and self._load_cache_info(input_path))
+
+    def _check_dependencies(self, needs_download=True):
+        """检查必要的依赖是否已安装，缺少可选依赖时只给出提示
+
+        下载镜像时create_rootfs_tar.py需要tar命令解压各层；只解压本地或已缓存的tar包时，
+        没有tar命令也可以用Python的tarfile解压
+        """
+        # 只在PATH中查找可执行文件，不再为每个命令fork一次 --version
+        tar_hint = "请安装tar: pkg install tar (Termux) 或 apt install tar"
+        dependencies = [
+            ('proot', "请安装proot: pkg install proot (Termux) 或 apt install proot"),
+            ('curl', "请安装curl: pkg install curl (Termux) 或 apt install curl"),   # create_rootfs_tar.py需要
+        ]
+        optional_dependencies = [
+            ('tee', "未安装tee，下载镜像时先写入缓存再解压: pkg install coreutils (Termux) 或 apt install coreutils"),
+        ]
+        if needs_download:
+            dependencies.append(('tar', tar_hint))
+        else:
+            optional_dependencies.append(('tar', f"未安装tar，将使用Python的tarfile解压（较慢）。{tar_hint}"))
+        for name, install_hint in dependencies:
+            if not _find_executable(name):
+                logger.error(f"✗ {name} 未安装")
+                logger.info(install_hint)
+                return False
+            logger.info(f"✓ {name} 已安装")
+
+            if name == 'proot':
+                # Since we are using `python -m`, we don't need to check for the script path here.
+                # The python interpreter will find the module.
+                logger.info("✓ create_rootfs_tar.py module is available")
+
+        for name, fallback_hint in optional_dependencies:
+            if _find_executable(name):
+                logger.info(f"✓ {name} 已安装")
+            else:
+                logger.warning(f"✗ {name} 未安装")
+                logger.info(fallback_hint)
 
         return True
     
-    def _extract_rootfs_if_needed(self, rootfs_path, provided_rootfs_dir=None):
-        """如果输入是tar文件，则解压到指定目录"""
+    def _extract_rootfs_if_needed(self, rootfs_path, provided_rootfs_dir=None, tmpfs_size=_DEFAULT_TMPFS_SIZE,
+                                  manifest_digest=None):
+        """如果输入是tar文件，则解压到指定目录
+
+        manifest_digest为拉取的镜像的摘要，提供时才使用解压缓存；本地tar包总是直接解压
+        """
 
         # 1. 如果输入不是tar文件，按旧逻辑处理
         if not (rootfs_path.endswith('.tar') or rootfs_path.endswith('.tar.gz')):
@@ -239,50 +721,283 @@ class ProotRunner:
                 logger.error(f"无效的根文件系统路径: {rootfs_path}")
                 return None
 
-        # 2. 确定解压目标目录
+        # 2. 确定解压目标目录，临时目录在放得下时使用内存文件系统
+        temp_base = None
+        if not provided_rootfs_dir:
+            temp_base = self._pick_temp_base(self._estimate_extracted_size(rootfs_path), tmpfs_size * 1024 * 1024)
+        is_temp = self._make_rootfs_dir(provided_rootfs_dir, temp_base=temp_base)
+
+        # 3. 优先从已解压的缓存复制，省去解压缩；镜像第一次使用、缓存不可用或复制失败时直接解压tar文件
+        extracted_dir = self._ensure_extracted_rootfs(rootfs_path, manifest_digest) if manifest_digest else None
+        if extracted_dir and self._copy_extracted_rootfs(extracted_dir):
+            logger.info(f"根文件系统已解压到: {self.rootfs_dir}")
+            return self.rootfs_dir
+        try:
+            logger.info(f"检测到tar文件，正在解压: {rootfs_path} -> {self.rootfs_dir}")
+            self._fill_rootfs_dir(lambda target_dir: self._extract_tar(rootfs_path, target_dir))
+            logger.info(f"根文件系统已解压到: {self.rootfs_dir}")
+            return self.rootfs_dir
+        except (subprocess.CalledProcessError, tarfile.TarError, OSError) as e:
+            logger.error(f"解压失败: {e}")
+            if is_temp:
+                self._cleanup()
+            return None
+
+    def _fill_rootfs_dir(self, populate):
+        """调用populate(目录)生成根文件系统：先写到self.rootfs_dir旁的临时目录，成功后改名到位
+
+        _make_rootfs_dir创建的目标目录为空，改名可以直接替换它；失败时删除临时目录后重新抛出异常，
+        目标目录保持为空，持久化目录不会被下次启动当成完整的根文件系统
+        """
+        staging_dir = f"{self.rootfs_dir}.part{os.getpid()}.{threading.get_ident()}"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        try:
+            populate(staging_dir)
+            os.rename(staging_dir, self.rootfs_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+    def _copy_extracted_rootfs(self, extracted_dir):
+        """从解压缓存复制根文件系统，失败时返回False，由调用方改为解压tar包"""
+        logger.info(f"从解压缓存复制根文件系统: {extracted_dir} -> {self.rootfs_dir}")
+        try:
+            self._fill_rootfs_dir(lambda target_dir: subprocess.run(
+                ['cp', '-a', '--reflink=auto', os.path.join(extracted_dir, '.'), target_dir], check=True))
+            return True
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.warning(f"从解压缓存复制失败，改为解压tar包: {e}")
+        return False
+
+    def _extract_tar(self, tar_path, target_dir):
+        """解压tar文件，按扩展名判断是否经过gzip压缩"""
+        with open(tar_path, 'rb', buffering=_TAR_READ_BUFFER) as raw:
+            _advise_sequential(raw.fileno())
+            self._extract_tar_stream(raw, tar_path.endswith('.tar.gz'), target_dir)
+
+    def _extract_tar_stream(self, raw, compressed, target_dir):
+        """从文件对象读取tar数据并解包：优先调用tar命令，没有tar命令时用Python流式解压
+
+        tar命令解压大量小文件明显快于tarfile，因此Python实现只作为后备。
+        gzip都在本进程中解压（有isal时用igzip），比tar -z调用的gzip命令快
+        """
+        try:
+            with self._open_tar_stream(raw, compressed) as src:
+                if _find_executable('tar'):
+                    self._extract_tar_with_command(src, target_dir)
+                else:
+                    self._extract_tar_with_tarfile(src, target_dir)
+        except (EOFError, _InflateError) as e:
+            raise tarfile.ReadError(f"gzip数据损坏: {e}") from e
+
+    def _open_tar_stream(self, raw, compressed):
+        """返回读取未压缩tar数据的文件对象"""
+        if compressed:
+            return _gzip.GzipFile(fileobj=raw, mode='rb')
+        return contextlib.nullcontext(raw)
+
+    def _extract_tar_with_command(self, src, target_dir):
+        """把本进程解压出的tar数据通过管道交给tar命令解包"""
+        with subprocess.Popen(['tar', '-xf', '-', '-C', target_dir], stdin=subprocess.PIPE) as proc:
+            self._set_pipe_size(proc.stdin)
+            try:
+                shutil.copyfileobj(src, proc.stdin, _TAR_READ_BUFFER)
+            except BrokenPipeError:
+                # tar提前退出，错误由其退出码反映
+                pass
+        # 数据损坏时异常在此之前抛出，tar读到提前结束的输入后自行退出
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def _extract_tar_with_tarfile(self, src, target_dir):
+        """用tarfile流式解压，按顺序逐个成员解压，不在内存中保存成员列表"""
+        has_filter = hasattr(tarfile, 'tar_filter')
+        extract_kwargs = {'filter': 'fully_trusted'} if has_filter else {}
+        directories = []
+        cpu_count = os.cpu_count() or 1
+        with _RootfsTarFile.open(fileobj=src, mode='r|', bufsize=_TAR_STREAM_BUFFER) as tar, \
+                ThreadPoolExecutor(max_workers=min(8, cpu_count * 2)) as writer:
+            # 单核时多线程只会增加开销；root用户还需要按路径chown，文件必须已经写出
+            if cpu_count > 1 and os.geteuid() != 0:
+                tar._writer, tar._pending = writer, {}
+            for member in tar:
+                # 非root用户无法创建设备文件，/dev由proot绑定宿主目录提供
+                if member.isdev():
+                    continue
+                if has_filter:
+                    member = _rootfs_filter(member, target_dir)
+                    if member is None:
+                        continue
+                # 与extractall一样，目录的权限和时间最后再设置，避免只读目录阻止后续写入
+                if member.isdir():
+                    directories.append(member)
+                    tar.extract(member, target_dir, set_attrs=False, **extract_kwargs)
+                else:
+                    tar.extract(member, target_dir, **extract_kwargs)
+            tar.drain()
+            for member in reversed(directories):
+                path = os.path.join(target_dir, member.name)
+                tar.chown(member, path, False)
+                tar.chmod(member, path)
+                tar.utime(member, path)
+
+    def _get_extracted_rootfs_dir(self, manifest_digest):
+        """镜像对应的解压缓存目录，按manifest摘要区分，指向同一镜像的多个标签共用；摘要格式不对时返回None"""
+        if not _DIGEST_RE.match(manifest_digest):
+            return None
+        return os.path.join(self.cache_dir, 'rootfs', manifest_digest.replace(':', '-'))
+
+    def _ensure_extracted_rootfs(self, tar_path, manifest_digest):
+        """返回镜像已解压的缓存目录，镜像第一次使用或解压失败时返回None，由调用方直接解压
+
+        只使用一次的镜像不必多解压一份再复制，也不会在磁盘上长期保留两份；
+        第一次使用时只留下 .seen 标记，再次使用时才解压到缓存。
+        先解压到临时目录再改名，最后写入 .complete 标记，中途失败不会留下不完整的缓存
+        """
+        extracted_dir = self._get_extracted_rootfs_dir(manifest_digest)
+        if extracted_dir is None:
+            return None
+        try:
+            os.makedirs(os.path.dirname(extracted_dir), exist_ok=True)
+            lock = open(extracted_dir + '.lock', 'w')
+        except OSError as e:
+            logger.warning(f"无法使用解压缓存，直接解压: {e}")
+            return None
+        # 并发启动的容器使用同一镜像时，由第一个解压，其余等待后直接使用
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._ensure_extracted_rootfs_locked(tar_path, manifest_digest, extracted_dir)
+
+    def _ensure_extracted_rootfs_locked(self, tar_path, manifest_digest, extracted_dir):
+        sentinel = extracted_dir + '.complete'
+        try:
+            with open(sentinel, 'r') as f:
+                if f.read() == manifest_digest and os.path.isdir(extracted_dir):
+                    return extracted_dir
+        except OSError:
+            pass
+
+        if self._claim_first_use(manifest_digest):
+            return None
+
+        logger.info(f"解压到缓存: {tar_path} -> {extracted_dir}")
+        tmp_dir = f"{extracted_dir}.tmp{os.getpid()}.{threading.get_ident()}"
+        try:
+            if os.path.exists(sentinel):
+                os.remove(sentinel)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            self._extract_tar(tar_path, tmp_dir)
+            self._discard_trees([extracted_dir])
+            os.rename(tmp_dir, extracted_dir)
+            with open(sentinel + '.tmp', 'w') as f:
+                f.write(manifest_digest)
+            os.replace(sentinel + '.tmp', sentinel)
+            return extracted_dir
+        except (OSError, subprocess.CalledProcessError, tarfile.TarError) as e:
+            logger.warning(f"解压缓存失败，直接解压: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+
+    def _claim_first_use(self, manifest_digest):
+        """记录镜像已经使用过，是第一次使用时返回True"""
+        extracted_dir = self._get_extracted_rootfs_dir(manifest_digest)
+        if extracted_dir is None:
+            return True
+        seen = extracted_dir + '.seen'
+        if os.path.exists(seen):
+            return False
+        try:
+            os.makedirs(os.path.dirname(seen), exist_ok=True)
+            open(seen, 'w').close()
+        except OSError:
+            pass
+        return True
+
+    def _discard_extracted_rootfs(self, manifest_digest):
+        """删除镜像的解压缓存及其标记文件"""
+        extracted_dir = self._get_extracted_rootfs_dir(manifest_digest)
+        if extracted_dir is None:
+            return
+        for suffix in ('.complete', '.seen', '.lock'):
+            try:
+                os.remove(extracted_dir + suffix)
+            except FileNotFoundError:
+                pass
+        self._discard_trees([extracted_dir])
+
+    def _estimate_extracted_size(self, tar_path):
+        """估算tar包解压后的大小；.tar.gz读取gzip尾部的ISIZE，无法判断时返回None"""
+        try:
+            size = os.path.getsize(tar_path)
+            if not tar_path.endswith('.tar.gz'):
+                return size
+            with open(tar_path, 'rb') as f:
+                f.seek(-4, os.SEEK_END)
+                isize = int.from_bytes(f.read(4), 'little')
+        except OSError:
+            return None
+        # ISIZE只保存原始大小模2^32，小于压缩后大小说明已溢出
+        return isize if isize >= size else None
+
+    def _pick_temp_base(self, required_bytes, limit_bytes):
+        """选择放置临时根文件系统的内存文件系统目录，不合适时返回None（使用默认临时目录）"""
+        if required_bytes is None or required_bytes > limit_bytes:
+            return None
+        for base in ('/dev/shm', os.environ.get('XDG_RUNTIME_DIR')):
+            if not base or not os.access(base, os.W_OK | os.X_OK):
+                continue
+            try:
+                st = os.statvfs(base)
+            except OSError:
+                continue
+            if st.f_bavail * st.f_frsize >= required_bytes:
+                logger.debug(f"临时根文件系统使用内存文件系统: {base}")
+                return base
+        return None
+
+    def _make_rootfs_dir(self, provided_rootfs_dir=None, temp_base=None):
+        """创建解压目标目录并设置self.rootfs_dir，使用临时目录时返回True"""
         is_temp = False
         if provided_rootfs_dir:
             target_dir = provided_rootfs_dir
             self.temp_dir = None
         else:
-            self.temp_dir = tempfile.mkdtemp(prefix='proot_runner_')
+            self.temp_dir = tempfile.mkdtemp(prefix='proot_runner_', dir=temp_base)
             target_dir = os.path.join(self.temp_dir, 'rootfs')
             is_temp = True
         
         self.rootfs_dir = target_dir
         os.makedirs(self.rootfs_dir, exist_ok=True)
+        return is_temp
 
-        # 3. 解压tar文件
-        logger.info(f"检测到tar文件，正在解压: {rootfs_path} -> {self.rootfs_dir}")
-        if rootfs_path.endswith('.tar.gz'):
-            cmd = ['tar', '-xzf', rootfs_path, '-C', self.rootfs_dir]
-        else:
-            cmd = ['tar', '-xf', rootfs_path, '-C', self.rootfs_dir]
-        
+    def _dir_entries(self, path):
+        """一次readdir读取目录项，返回 {名称: os.DirEntry}，目录不可读时返回空字典"""
         try:
-            subprocess.run(cmd, check=True)
-            logger.info(f"根文件系统已解压到: {self.rootfs_dir}")
-            return self.rootfs_dir
-        except subprocess.CalledProcessError as e:
-            logger.error(f"解压失败: {e}")
-            if is_temp:
-                self._cleanup()
-            return None
-    
+            with os.scandir(path) as it:
+                return {entry.name: entry for entry in it}
+        except OSError:
+            return {}
+
     def _find_image_config(self):
         """查找镜像配置信息"""
-        # 尝试从多个可能的位置查找配置
-        config_paths = [
-            os.path.join(self.rootfs_dir, '.image_config.json'),
-            os.path.join(self.rootfs_dir, 'image_config.json'),
-            os.path.join(self.rootfs_dir, 'etc', 'image_config.json')
+        # 尝试从多个可能的位置查找配置，每个目录只读取一次
+        config_locations = [
+            ('', ['.image_config.json', 'image_config.json']),
+            ('etc', ['image_config.json'])
         ]
-        
-        for config_path in config_paths:
-            if os.path.exists(config_path):
+
+        for subdir, names in config_locations:
+            entries = self._dir_entries(os.path.join(self.rootfs_dir, subdir))
+            for name in names:
+                entry = entries.get(name)
+                if entry is None or not entry.is_file():
+                    continue
+                config_path = entry.path
                 try:
-                    with open(config_path, 'r') as f:
-                        self.config_data = json.load(f)
+                    with open(config_path, 'rb') as f:
+                        self.config_data, self._image_env = _parse_image_config(f.read())
                     logger.info(f"找到镜像配置: {config_path}")
                     return True
                 except Exception as e:
@@ -310,18 +1025,13 @@ class ProotRunner:
                 return cmd
 
         # 默认命令 - 查找可用的shell
-        default_shells = ['/bin/bash', '/bin/sh', '/bin/ash', '/bin/dash']
-        for shell in default_shells:
-            shell_path = os.path.join(self.rootfs_dir, shell.lstrip('/'))
-            if os.path.exists(shell_path):
-                logger.debug(f"找到可用shell: {shell}")
-                return [shell]
-
-        # 如果没有找到shell，尝试busybox
-        busybox_path = os.path.join(self.rootfs_dir, 'bin/busybox')
-        if os.path.exists(busybox_path):
+        shell = self._find_shell()
+        if shell == '/bin/busybox':
             logger.debug("使用busybox shell")
             return ['/bin/busybox', 'sh']
+        if shell:
+            logger.debug(f"找到可用shell: {shell}")
+            return [shell]
 
         logger.warning("未找到可用的shell，使用默认/bin/sh")
         return ['/bin/sh']  # 最后的备选
@@ -329,34 +1039,35 @@ class ProotRunner:
     def _get_available_shell(self):
         """获取可用的shell路径（用于执行脚本）"""
         # 查找可用的shell
-        default_shells = ['/bin/bash', '/bin/sh', '/bin/ash', '/bin/dash']
-        for shell in default_shells:
-            shell_path = os.path.join(self.rootfs_dir, shell.lstrip('/'))
-            if os.path.exists(shell_path):
-                logger.debug(f"找到可用shell用于执行脚本: {shell}")
-                return shell
-
-        # 如果没有找到shell，尝试busybox
-        busybox_path = os.path.join(self.rootfs_dir, 'bin/busybox')
-        if os.path.exists(busybox_path):
+        shell = self._find_shell()
+        if shell == '/bin/busybox':
             logger.debug("使用busybox shell执行脚本")
-            return '/bin/busybox'
+            return shell
+        if shell:
+            logger.debug(f"找到可用shell用于执行脚本: {shell}")
+            return shell
 
         logger.warning("未找到可用的shell执行脚本，使用默认/bin/sh")
         return '/bin/sh'  # 最后的备选
 
+    def _find_shell(self):
+        """按 bash、sh、ash、dash、busybox 的顺序返回rootfs中第一个存在的shell，都没有时返回None
+
+        rootfs/bin只读取一次目录项，在内存中判断，根文件系统改变后重新读取
+        """
+        if self._bin_names is None or self._bin_names[0] != self.rootfs_dir:
+            names = frozenset(self._dir_entries(os.path.join(self.rootfs_dir, 'bin')))
+            self._bin_names = (self.rootfs_dir, names)
+        names = self._bin_names[1]
+        for name in ('bash', 'sh', 'ash', 'dash', 'busybox'):
+            if name in names:
+                return f'/bin/{name}'
+        return None
+
     def _get_default_env(self):
         """获取默认环境变量"""
-        env_vars = {}
-        
-        if self.config_data:
-            config = self.config_data.get('config', {})
-            env_list = config.get('Env', [])
-            
-            for env_str in env_list:
-                if '=' in env_str:
-                    key, value = env_str.split('=', 1)
-                    env_vars[key] = value
+        # 镜像的环境变量在解析配置时已拆分好
+        env_vars = dict(self._image_env)
         
         # 添加一些基本的环境变量
         env_vars.setdefault('PATH', '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin')
@@ -387,32 +1098,9 @@ class ProotRunner:
             # This block is now empty as proot doesn't support pid file args
             pass
 
-        # 绑定挂载
-        default_binds = [
-            '/dev',
-            '/proc',
-            '/sys'
-        ]
-
-        # 在Android/Termux中添加额外的绑定
-        if self._is_android_environment():
-            default_binds.extend([
-                '/sdcard',
-                '/system/etc/resolv.conf:/etc/resolv.conf'
-            ])
-
-        for bind in default_binds:
-            if ':' in bind:
-                src, dst = bind.split(':', 1)
-                if os.path.exists(src):
-                    cmd.extend(['-b', bind])
-            else:
-                if os.path.exists(bind):
-                    cmd.extend(['-b', bind])
-
-        # 用户指定的绑定挂载
-        for bind in args.bind:
-            cmd.extend(['-b', bind])
+        # 绑定挂载：默认绑定（已展开的参数）+ 用户指定的绑定
+        cmd.extend(self._default_bind_args)
+        cmd.extend([arg for bind in args.bind for arg in ('-b', bind)])
 
         # 工作目录
         workdir = args.workdir or self._get_working_directory()
@@ -471,8 +1159,7 @@ class ProotRunner:
         # 添加环境变量设置
         for key, value in env_vars.items():
             # 转义特殊字符
-            escaped_value = value.replace('"', '\\"').replace('$', '\\$').replace('`', '\\`')
-            script_content.append(f'export {key}="{escaped_value}"')
+            script_content.append(f'export {key}="{value.translate(_DQUOTE_ESCAPES)}"')
 
         # 在Android环境中添加特殊处理
         if self._is_android_environment():
@@ -487,31 +1174,45 @@ class ProotRunner:
             quoted_command_str = shlex.quote(command[2])
             script_content.append(f'exec {command[0]} {command[1]} {quoted_command_str}')
         else:
-            command_str = ' '.join(f'"{arg}"' if ' ' in arg else arg for arg in command)
-            script_content.append(f'exec {command_str}')
+            script_content.append(f'exec {shlex.join(command)}')
 
-        # 写入临时脚本文件
+        script = '\n'.join(script_content) + '\n'
         script_path = os.path.join(self.rootfs_dir, 'startup.sh')
-        with open(script_path, 'w') as f:
-            f.write('\n'.join(script_content) + '\n')
 
-        # 设置执行权限
-        os.chmod(script_path, 0o755)
+        # 持久化根文件系统重启时脚本通常没有变化，内容相同就不再重写
+        try:
+            with open(script_path, 'r') as f:
+                unchanged = f.read() == script and os.access(script_path, os.X_OK)
+        except (OSError, UnicodeDecodeError):
+            unchanged = False
+
+        if not unchanged:
+            # 创建时直接带上执行权限；O_CREAT的mode只对新文件生效且受umask影响，不符时才fchmod
+            fd = os.open(script_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o755)
+            try:
+                view = memoryview(script.encode())
+                while view:
+                    view = view[os.write(fd, view):]
+                if stat.S_IMODE(os.fstat(fd).st_mode) != 0o755:
+                    os.fchmod(fd, 0o755)
+            finally:
+                os.close(fd)
 
         logger.debug(f"创建启动脚本: {script_path}")
-        logger.debug(f"脚本内容:\n{chr(10).join(script_content)}")
+        logger.debug(f"脚本内容:\n{script}")
         return '/startup.sh'
     
     def _is_android_environment(self):
-        """检测是否在Android环境中运行"""
-        android_indicators = [
-            '/data/data/com.termux' in os.getcwd(),
-            os.path.exists('/system/build.prop'),
-            os.environ.get('ANDROID_DATA') is not None,
-            os.environ.get('TERMUX_VERSION') is not None
-        ]
-        
-        return any(android_indicators)
+        """检测是否在Android环境中运行，结果在实例内缓存"""
+        if self._android is None:
+            # 按开销从小到大检查并短路：环境变量 → stat → getcwd
+            self._android = (
+                os.environ.get('TERMUX_VERSION') is not None
+                or os.environ.get('ANDROID_DATA') is not None
+                or os.path.exists('/system/build.prop')
+                or '/data/data/com.termux' in os.getcwd()
+            )
+        return self._android
 
     def _prepare_environment(self):
         """准备运行环境，处理Android Termux特殊问题"""
@@ -542,10 +1243,10 @@ class ProotRunner:
     
     def run(self, input_path, args, rootfs_dir=None, pid_file=None):
         """运行容器（一条龙服务）"""
-        log_file_handle = None
+        log_fd = None
         try:
             # 检查依赖
-            if not self._check_dependencies():
+            if not self._check_dependencies(self._needs_download(input_path, args, rootfs_dir)):
                 return False
 
             # 准备根文件系统（下载或使用现有）
@@ -575,73 +1276,45 @@ class ProotRunner:
 
             # 日志文件处理
             log_file_path = getattr(args, 'log_file', None)
-            log_file_handle = None
             if log_file_path:
                 try:
-                    # Append to the log file
-                    log_file_handle = open(log_file_path, 'a')
-                except IOError as e:
+                    # 以追加模式打开原始fd，只用于重定向，无需Python层缓冲
+                    log_fd = os.open(log_file_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                except OSError as e:
                     logger.error(f"无法打开日志文件 {log_file_path}: {e}")
 
             # 运行proot
+            env = self._prepare_environment()
             if args.detach:
-                # 手动实现后台化 (fork/exec)
-                env = self._prepare_environment()
-                pid_file_path = getattr(args, 'pid_file', None)
-
-                try:
-                    pid = os.fork()
-                    if pid > 0:
-                        # 父进程
-                        logger.info(f"容器已在后台启动，PID: {pid}")
-                        if pid_file_path:
-                            try:
-                                with open(pid_file_path, 'w') as f:
-                                    f.write(str(pid))
-                                logger.debug(f"PID {pid} 已写入 {pid_file_path}")
-                            except IOError as e:
-                                logger.error(f"写入PID文件失败: {e}")
-                        # 父进程成功写入PID后退出
-                        return True
-
-                    # 子进程
-                    os.setsid() # 创建新会话，脱离控制终端
-                    
-                    # 重定向标准文件描述符
-                    sys.stdout.flush()
-                    sys.stderr.flush()
-                    
-                    stdout_dest = log_file_handle or open(os.devnull, 'wb')
-                    stderr_dest = log_file_handle or open(os.devnull, 'wb')
-                    
-                    os.dup2(stdout_dest.fileno(), sys.stdout.fileno())
-                    os.dup2(stderr_dest.fileno(), sys.stderr.fileno())
-                    
-                    # stdin重定向到/dev/null
-                    with open(os.devnull, 'rb') as devnull:
-                        os.dup2(devnull.fileno(), sys.stdin.fileno())
-
-                    # 执行proot命令
-                    os.execvpe(proot_cmd[0], proot_cmd, env)
-
-                except Exception as e:
-                    logger.error(f"后台启动失败 (fork/exec): {e}")
-                    # 子进程如果exec失败，需要手动退出
-                    sys.exit(1)
+                mode = 'detach'
+                # 后台模式下没有日志文件时丢弃输出
+                if log_fd is None:
+                    log_fd = os.open(os.devnull, os.O_WRONLY)
+            elif getattr(args, 'interactive', False):
+                mode = 'interactive'
             else:
-                # 前台运行（交互式或非交互式）
+                mode = 'foreground'
+
+            if not args.detach:
                 logger.info("进入容器环境...")
-                env = self._prepare_environment()
-                
-                # 根据是否为交互式模式设置stdin/stdout/stderr
-                if getattr(args, 'interactive', False):
-                    # 交互式模式：连接到终端
-                    subprocess.run(proot_cmd, env=env)
-                else:
-                    # 非交互式模式：重定向到日志文件（如果提供）
-                    subprocess.run(proot_cmd, env=env, stdout=log_file_handle, stderr=log_file_handle)
+
+            pid = self._spawn(proot_cmd, env, _STDIO_MODES[mode], log_fd, new_session=args.detach)
+
+            if args.detach:
+                logger.info(f"容器已在后台启动，PID: {pid}")
+                pid_file_path = getattr(args, 'pid_file', None)
+                if pid_file_path:
+                    try:
+                        with open(pid_file_path, 'w') as f:
+                            f.write(str(pid))
+                        logger.debug(f"PID {pid} 已写入 {pid_file_path}")
+                    except IOError as e:
+                        logger.error(f"写入PID文件失败: {e}")
                 return True
 
+            self._wait_for_child(pid)
+            return True
+
         except KeyboardInterrupt:
             logger.info("用户中断")
             return True
@@ -649,44 +1322,143 @@ class ProotRunner:
             logger.error(f"运行失败: {e}")
             return False
         finally:
-            # 关闭日志文件句柄
-            if log_file_handle:
-                log_file_handle.close()
+            # 关闭日志文件描述符
+            if log_fd is not None:
+                os.close(log_fd)
 
             # 只有在前台运行时，并且我们创建了临时目录时，才进行清理
             if hasattr(args, 'detach') and not args.detach:
                 self._cleanup()
     
+    def _spawn(self, cmd, env, stdio, log_fd, new_session=False):
+        """启动子进程，按stdio描述重定向标准文件描述符，返回PID"""
+        stdio_fds = []
+        opened_fds = []
+        try:
+            for source in stdio:
+                if source == 'null':
+                    source_fd = os.open(os.devnull, os.O_RDWR)
+                    opened_fds.append(source_fd)
+                elif source == 'log' and log_fd is not None:
+                    source_fd = log_fd
+                else:
+                    source_fd = None
+                stdio_fds.append(source_fd)
+
+            return spawn_process(cmd, env, tuple(stdio_fds), new_session)
+        finally:
+            for fd in opened_fds:
+                os.close(fd)
+
+    def _wait_for_child(self, pid):
+        """等待前台子进程结束，被中断时终止子进程"""
+        try:
+            wait_process(pid)
+        except KeyboardInterrupt:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                wait_process(pid)
+            except OSError:
+                pass
+            raise
+
     def _cleanup(self):
-        """清理临时文件"""
+        """清理临时文件，临时目录名唯一，无需改名即可交给后台删除"""
         if self.temp_dir and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
+            self._delete_in_background([self.temp_dir])
             logger.info(f"清理临时目录: {self.temp_dir}")
 
+    def _get_trash_dir(self):
+        """待删除目录的回收目录，与缓存位于同一文件系统，移入时只需一次改名"""
+        return os.path.join(self.cache_dir, '.trash')
+
+    def _sweep_trash(self):
+        """删除回收目录中上次后台删除被中断时残留的内容"""
+        trash_dir = self._get_trash_dir()
+        if trash_dir in _swept_trash_dirs:
+            return
+        _swept_trash_dirs.add(trash_dir)
+        leftovers = [entry.path for entry in self._dir_entries(trash_dir).values()]
+        if leftovers:
+            self._delete_in_background(leftovers)
+        # 旧版本按文件去重时使用的对象库，以及按tar包路径区分的解压缓存已不再需要
+        legacy = [os.path.join(self.cache_dir, 'objects')]
+        for name, entry in self._dir_entries(os.path.join(self.cache_dir, 'rootfs')).items():
+            if _LEGACY_EXTRACTED_RE.match(name):
+                if entry.is_dir(follow_symlinks=False):
+                    legacy.append(entry.path)
+                    continue
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        self._discard_trees(legacy)
+
+    def _discard_trees(self, paths):
+        """把目录改名移入回收目录后交给后台删除，原路径立即可以重新使用"""
+        trash_dir = self._get_trash_dir()
+        moved = []
+        for path in paths:
+            trash = os.path.join(trash_dir, uuid.uuid4().hex)
+            try:
+                os.makedirs(trash_dir, exist_ok=True)
+                os.rename(path, trash)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            moved.append(trash)
+
+        if moved:
+            self._delete_in_background(moved)
+
+    def _delete_in_background(self, paths):
+        """在新会话中用rm -rf删除路径，不等待其结束
+
+        rm在C中逐项unlinkat，比shutil.rmtree逐项调用快，也不再占用命令返回前的时间
+        """
+        cmd = ['rm', '-rf', '--', *paths]
+
+        pid = None
+        if _find_executable(cmd[0]):
+            try:
+                pid = self._spawn(cmd, os.environ, ('null', 'null', 'null'), None, new_session=True)
+            except Exception as e:
+                # 无论启动失败的原因是什么，都改为同步删除，保证调用方已更新的记录与磁盘一致
+                logger.debug(f"无法启动后台删除: {e}")
+        if pid is None:
+            for path in paths:
+                shutil.rmtree(path, ignore_errors=True)
+            return
+        # 由守护线程回收子进程，常驻的守护进程中也不会残留僵尸进程
+        threading.Thread(target=wait_process, args=(pid,), daemon=True).start()
+
     def list_cache(self):
         """列出缓存的镜像"""
         if not os.path.exists(self.cache_dir):
             logger.info("缓存目录不存在")
             return
 
+        # 一次readdir同时得到tar包和.info文件，tar包大小取自目录项的stat
+        entries = self._dir_entries(self.cache_dir)
         cache_files = []
-        for filename in os.listdir(self.cache_dir):
+        for filename, entry in sorted(entries.items()):
             if filename.endswith('.tar.gz'):
-                cache_path = os.path.join(self.cache_dir, filename)
-                info_path = cache_path + '.info'
-
                 # 获取文件信息
-                stat = os.stat(cache_path)
-                size_mb = stat.st_size / 1024 / 1024
+                try:
+                    size_mb = entry.stat().st_size / 1024 / 1024
+                except OSError:
+                    continue
 
                 # 尝试读取缓存信息
                 image_url = "Unknown"
                 created_time = "Unknown"
 
-                if os.path.exists(info_path):
+                info_entry = entries.get(filename + '.info')
+                if info_entry is not None:
                     try:
-                        with open(info_path, 'r') as f:
-                            info = json.load(f)
+                        info = _load_json(info_entry.path)
                         image_url = info.get('image_url', 'Unknown')
                         created_time = info.get('created_time_str', 'Unknown')
                     except Exception:
@@ -720,6 +1492,10 @@ class ProotRunner:
             # 清理特定镜像的缓存
             cache_path = self._get_image_cache_path(image_url)
             info_path = self._get_cache_info_path(image_url)
+            try:
+                manifest_digest = _load_json(info_path).get('manifest_digest')
+            except (OSError, ValueError):
+                manifest_digest = None
 
             removed = False
             for path in [cache_path, info_path]:
@@ -727,6 +1503,9 @@ class ProotRunner:
                     os.remove(path)
                     removed = True
 
+            if manifest_digest:
+                self._discard_extracted_rootfs(manifest_digest)
+
             if removed:
                 logger.info(f"已清理镜像缓存: {image_url}")
             else:
@@ -734,13 +1513,22 @@ class ProotRunner:
         else:
             # 清理所有缓存
             if os.path.exists(self.cache_dir):
-                shutil.rmtree(self.cache_dir)
-                self._ensure_cache_dir()
+                # 目录移入回收目录后在后台删除，文件直接删除
+                dirs = []
+                for name, entry in self._dir_entries(self.cache_dir).items():
+                    if name == '.trash':
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    else:
+                        os.remove(entry.path)
+                self._discard_trees(dirs)
                 logger.info("已清理所有缓存")
             else:
                 logger.info("缓存目录不存在")
 
-def main():
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='使用proot运行Docker镜像的一条龙服务',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -827,6 +1615,12 @@ def main():
         '--cache-dir',
         help='指定缓存目录路径'
     )
+    parser.add_argument(
+        '--tmpfs-size',
+        type=int,
+        default=_DEFAULT_TMPFS_SIZE,
+        help=f'解压后不超过该大小(MiB)的临时根文件系统放在/dev/shm等内存文件系统中，0表示禁用 (默认: {_DEFAULT_TMPFS_SIZE})'
+    )
     parser.add_argument('--username', help='Registry用户名')
     parser.add_argument('--password', help='Registry密码')
 
@@ -856,7 +1650,7 @@ def main():
         help='清理指定镜像的缓存，或使用"all"清理所有缓存'
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -885,5 +1679,6 @@ def main():
 
     sys.exit(0 if success else 1)
 
+
 if __name__ == '__main__':
     main()
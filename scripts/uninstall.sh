@@ -47,6 +47,16 @@ check_termux() {
     fi
 }
 
+# 判断命令文件是否为本工具创建的包装脚本
+# 标记位于脚本开头，只读取前4KiB；超过1MiB的文件必然不是包装脚本
+is_wrapper_script() {
+    size=$(wc -c < "$1" 2>/dev/null) || return 1
+    if [ "$size" -gt 1048576 ]; then
+        return 1
+    fi
+    head -c 4096 "$1" 2>/dev/null | grep -q "android-docker-cli"
+}
+
 # 检查安装
 check_installation() {
     INSTALL_DIR="$HOME/.android-docker-cli"
@@ -100,15 +110,21 @@ uninstall_commands() {
     DOCKER_COMPOSE_CMD="$PREFIX/bin/docker-compose"
     
     if [ -f "$DOCKER_CMD" ]; then
-        print_info "删除docker命令: $DOCKER_CMD"
-        if rm -f "$DOCKER_CMD"; then
-            print_success "docker命令已删除"
+        if ! is_wrapper_script "$DOCKER_CMD"; then
+            print_warning "跳过 $DOCKER_CMD：不是Android Docker CLI的包装脚本"
         else
-            print_warning "删除docker命令失败，可能需要sudo权限"
+            print_info "删除docker命令: $DOCKER_CMD"
+            if rm -f "$DOCKER_CMD"; then
+                print_success "docker命令已删除"
+            else
+                print_warning "删除docker命令失败，可能需要sudo权限"
+            fi
         fi
     fi
     
-    if [ -f "$DOCKER_COMPOSE_CMD" ]; then
+    if [ -f "$DOCKER_COMPOSE_CMD" ] && ! is_wrapper_script "$DOCKER_COMPOSE_CMD"; then
+        print_warning "跳过 $DOCKER_COMPOSE_CMD：不是Android Docker CLI的包装脚本"
+    elif [ -f "$DOCKER_COMPOSE_CMD" ]; then
         print_info "删除docker-compose命令: $DOCKER_COMPOSE_CMD"
         if rm -f "$DOCKER_COMPOSE_CMD"; then
             print_success "docker-compose命令已删除"
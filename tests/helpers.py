@@ -0,0 +1,39 @@
+"""集成测试共用的常量和缓存清理函数"""
+import os
+import shutil
+
+# pytest-xdist 并发运行时每个 worker 使用独立的缓存目录和容器名，单独运行时为 gw0
+WORKER = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+
+# 子进程只读取 setUpClass 中预先编译好的pyc，不再各自写入；输出固定用UTF-8编码，
+# 由测试按字节读取后一次解码，与区域设置无关。
+# 不使用 -I/-s：隔离模式会把当前目录移出 sys.path，找不到未安装的 android_docker 包，
+# 而 yaml 等依赖可能装在用户site目录中
+CHILD_ENV = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1", "PYTHONIOENCODING": "utf-8"}
+
+# 设置 DOCKER_CLI_TEST_VERBOSE=1 时打印执行的每条命令；失败信息中总会包含命令本身
+VERBOSE = os.environ.get("DOCKER_CLI_TEST_VERBOSE") == "1"
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "android_docker")
+
+# 镜像缓存（tar包及其.info、解压缓存）在多次测试运行之间保留，避免每次重新下载；
+# 设置 DOCKER_CLI_TEST_CLEAN=1（如CI）时每次都清空整个缓存目录
+CLEAN_CACHE = os.environ.get("DOCKER_CLI_TEST_CLEAN") == "1"
+IMAGE_CACHE_DIRS = ("rootfs", ".trash")
+IMAGE_CACHE_SUFFIXES = (".tar.gz", ".tar.gz.info")
+
+
+def reset_test_cache(cache_dir):
+    """删除缓存目录中的容器等状态，保留镜像缓存。"""
+    if CLEAN_CACHE:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        return
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name in IMAGE_CACHE_DIRS or name.endswith(IMAGE_CACHE_SUFFIXES):
+            continue
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
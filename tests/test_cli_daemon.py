@@ -0,0 +1,152 @@
+import unittest
+import os
+import logging
+import socket
+import tempfile
+import threading
+from unittest import mock
+
+from android_docker import cli_daemon
+
+
+class TestSocketDir(unittest.TestCase):
+    """
+    套接字放在当前用户私有的0700目录中。
+    """
+
+    def setUp(self):
+        self.runtime_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.runtime_dir.cleanup)
+        patcher = mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.runtime_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_creates_private_dir(self):
+        """测试自动创建0700权限的目录"""
+        sock_path = cli_daemon.get_socket_path()
+        mode = os.stat(os.path.dirname(sock_path)).st_mode
+        self.assertEqual(mode & 0o777, 0o700)
+
+    def test_rejects_shared_dir(self):
+        """测试其他用户可访问的目录被拒绝"""
+        os.mkdir(os.path.join(self.runtime_dir.name, "android-docker"), 0o755)
+        os.chmod(os.path.join(self.runtime_dir.name, "android-docker"), 0o755)
+        with self.assertRaises(PermissionError):
+            cli_daemon.get_socket_path()
+
+
+class TestPeerCheck(unittest.TestCase):
+    """
+    只接受同一用户的对端进程。
+    """
+
+    def test_same_user_accepted(self):
+        """测试同一用户的连接通过检查"""
+        left, right = socket.socketpair()
+        with left, right:
+            cli_daemon._check_peer(left)
+
+    def test_other_user_rejected(self):
+        """测试其他用户的连接被拒绝"""
+        with mock.patch.object(cli_daemon, "_peer_uid", return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                cli_daemon._check_peer(mock.Mock())
+
+
+class TestExecute(unittest.TestCase):
+    """
+    每个请求使用客户端的环境变量和工作目录，执行后恢复。
+    """
+
+    def test_uses_client_env_and_cwd(self):
+        """测试命令在客户端的环境变量和工作目录中执行"""
+        seen = {}
+
+        def fake_run_stages(stages):
+            seen.update(env=os.environ.get("CLIENT_ONLY"), cwd=os.getcwd())
+            return 0
+
+        with tempfile.TemporaryDirectory() as cwd, tempfile.TemporaryFile() as out:
+            fds = [out.fileno()] * 3
+            request = {"env": {**os.environ, "CLIENT_ONLY": "yes"}, "cwd": cwd, "stages": []}
+            with mock.patch.object(cli_daemon, "run_stages", side_effect=fake_run_stages):
+                self.assertEqual(cli_daemon._execute(fds, request), 0)
+            self.assertEqual(seen, {"env": "yes", "cwd": os.path.realpath(cwd)})
+        self.assertNotIn("CLIENT_ONLY", os.environ)
+        self.assertNotEqual(os.getcwd(), seen["cwd"])
+
+
+    def test_restores_log_level(self):
+        """测试客户端的 --verbose 只作用于本次请求，之后恢复原来的日志级别"""
+        root_logger = logging.getLogger()
+        original_level = root_logger.level
+        self.addCleanup(root_logger.setLevel, original_level)
+        root_logger.setLevel(logging.WARNING)
+
+        def verbose_run_stages(stages):
+            root_logger.setLevel(logging.DEBUG)
+            return 0
+
+        with tempfile.TemporaryDirectory() as cwd, tempfile.TemporaryFile() as out:
+            request = {"env": dict(os.environ), "cwd": cwd, "stages": []}
+            with mock.patch.object(cli_daemon, "run_stages", side_effect=verbose_run_stages):
+                cli_daemon._execute([out.fileno()] * 3, request)
+        self.assertEqual(root_logger.level, logging.WARNING)
+
+
+class TestSocketOwnership(unittest.TestCase):
+    """
+    同时只有一个守护进程监听，退出时不删除其他守护进程的套接字。
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+        self.sock_path = os.path.join(self.work_dir.name, "test.sock")
+
+    def _start_serving(self):
+        """在线程中运行守护进程，可以连接后返回线程"""
+        thread = threading.Thread(target=cli_daemon.serve, args=(self.sock_path, 0.5))
+        thread.start()
+        self.addCleanup(thread.join)
+        for _ in range(100):
+            try:
+                cli_daemon._try_connect(self.sock_path).close()
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                thread.join(0.01)
+        return thread
+
+    def test_second_daemon_keeps_live_socket(self):
+        """测试已有守护进程在运行时，新启动的守护进程直接退出且不删除其套接字"""
+        thread = self._start_serving()
+        inode = os.stat(self.sock_path).st_ino
+        cli_daemon.serve(self.sock_path, idle_timeout=0.5)
+        self.assertEqual(os.stat(self.sock_path).st_ino, inode)
+        thread.join()
+        self.assertFalse(os.path.exists(self.sock_path))
+
+    def test_stale_socket_is_replaced(self):
+        """测试已退出的守护进程留下的套接字被替换"""
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.sock_path)
+        stale.close()
+        self._start_serving()
+        cli_daemon._try_connect(self.sock_path).close()
+
+    def test_stop_keeps_replaced_socket(self):
+        """测试路径已指向其他套接字时，退出的守护进程不删除它"""
+        lock = cli_daemon._acquire_socket_lock(self.sock_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.sock_path)
+        inode = os.stat(self.sock_path).st_ino
+        os.unlink(self.sock_path)
+        other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(other.close)
+        other.bind(self.sock_path)
+        cli_daemon._stop_listening(server, self.sock_path, inode, lock)
+        self.assertTrue(os.path.exists(self.sock_path))
+        self.assertIsNotNone(cli_daemon._acquire_socket_lock(self.sock_path))
+
+if __name__ == '__main__':
+    unittest.main()
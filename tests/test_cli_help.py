@@ -0,0 +1,68 @@
+import unittest
+import io
+import argparse
+import contextlib
+
+from android_docker.docker_cli import create_parser
+from android_docker import create_rootfs_tar
+
+
+def _subcommands(parser, prefix=()):
+    """递归列出解析器的所有子命令路径，例如 ('network', 'create')"""
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            for name, subparser in action.choices.items():
+                path = prefix + (name,)
+                yield path
+                yield from _subcommands(subparser, path)
+
+
+class TestDockerCLIHelp(unittest.TestCase):
+    """
+    在同一进程中检查所有子命令的 --help 输出，避免每条命令启动一次解释器。
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """所有检查共享同一个解析器。"""
+        cls.parser = create_parser()
+
+    def _help(self, argv):
+        """解析 argv + --help，返回帮助文本。"""
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf), self.assertRaises(SystemExit) as cm:
+            self.parser.parse_args(list(argv) + ["--help"])
+        self.assertEqual(cm.exception.code, 0)
+        return buf.getvalue()
+
+    def test_main_help(self):
+        """测试 docker --help"""
+        self.assertIn("usage: docker", self._help([]))
+
+
+def _make_help_test(path):
+    def test(self):
+        self.assertIn(f"usage: docker {' '.join(path)}", self._help(path))
+    test.__doc__ = f"测试 docker {' '.join(path)} --help"
+    return test
+
+
+# 每个子命令生成一个独立的测试方法，可以用 -k 单独选择，失败时也分别报告
+for _path in _subcommands(create_parser()):
+    setattr(TestDockerCLIHelp, "test_help_" + "_".join(_path), _make_help_test(_path))
+
+
+class TestCreateRootfsTarHelp(unittest.TestCase):
+    """
+    在进程内检查 create_rootfs_tar 的命令行选项。
+    """
+
+    def test_quiet_and_verbose_options(self):
+        """测试 create_rootfs_tar --help 中的 --quiet 和 --verbose"""
+        help_text = create_rootfs_tar.create_parser().format_help()
+        self.assertIn("--quiet", help_text)
+        self.assertIn("--verbose", help_text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,39 +3,181 @@ import os
 import sys
 import subprocess
 import shutil
+import compileall
 import time
 import json
+import shlex
+import signal
+import threading
+import tempfile
+import io
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from android_docker.docker_cli import BATCH_SEPARATOR
+from tests.helpers import WORKER, CHILD_ENV, VERBOSE, PACKAGE_DIR, reset_test_cache
+
+# 单条命令的最长执行时间（秒），包含拉取镜像
+COMMAND_TIMEOUT = 300
+
 
 class TestDockerCLI(unittest.TestCase):
     """
     对 docker_cli.py 和相关脚本进行集成测试。
     """
     TEST_IMAGE = "swr.cn-north-4.myhuaweicloud.com/ddn-k8s/docker.io/library/alpine:latest"
-    TEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".docker_proot_cache_test")
+    NGINX_IMAGE = "swr.cn-north-4.myhuaweicloud.com/ddn-k8s/docker.io/library/nginx:alpine"
+    TEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), f".docker_proot_cache_test_{WORKER}")
     # We will now run the CLI as a module, so this path is no longer needed.
 
     @classmethod
     def setUpClass(cls):
-        """在所有测试开始前，清理并创建测试缓存目录。"""
-        if os.path.exists(cls.TEST_CACHE_DIR):
-            shutil.rmtree(cls.TEST_CACHE_DIR)
-        os.makedirs(cls.TEST_CACHE_DIR)
+        """在所有测试开始前，清理容器状态并创建测试缓存目录。"""
+        reset_test_cache(cls.TEST_CACHE_DIR)
+        os.makedirs(cls.TEST_CACHE_DIR, exist_ok=True)
+        compileall.compile_dir(PACKAGE_DIR, quiet=1)
+        # Run as a module to ensure correct package imports
+        cls.BASE_CMD = (sys.executable, "-m", "android_docker.docker_cli", "--cache-dir", cls.TEST_CACHE_DIR)
+
+        # test_09 使用的 nginx 镜像在后台线程中拉取，与下面共用镜像的拉取同时进行
+        cls._pull_executor = ThreadPoolExecutor(max_workers=1)
+        cls._nginx_pull = cls._pull_executor.submit(cls._execute, ["pull", cls.NGINX_IMAGE])
+
+        # 所有测试共用的镜像在这里拉取一次，测试之间不再依赖 test_01 先执行；已缓存时只比较摘要
+        result = cls._execute(["pull", cls.TEST_IMAGE])
+        if result.returncode != 0:
+            # 失败时不会调用 tearDownClass，在这里等后台拉取结束
+            cls._pull_executor.shutdown()
+            raise AssertionError(f"拉取测试镜像失败: {cls._describe(result)}")
 
     @classmethod
     def tearDownClass(cls):
-        """在所有测试结束后，清理测试缓存目录。"""
-        if os.path.exists(cls.TEST_CACHE_DIR):
-            shutil.rmtree(cls.TEST_CACHE_DIR)
+        """在所有测试结束后，清理容器状态，保留镜像缓存。"""
+        cls._pull_executor.shutdown()
+        reset_test_cache(cls.TEST_CACHE_DIR)
+
+    @classmethod
+    def _execute(cls, command, input=None):
+        """执行 docker_cli.py 命令，返回合并了标准错误的输出。"""
+        cmd = [*cls.BASE_CMD, *command]
+        if VERBOSE:
+            print(f"\nExecuting: {' '.join(cmd)}")
+        # 输出写入临时文件而不是管道：不受管道缓冲区限制，
+        # 也不会因为后台容器进程继承了管道写端而一直等不到EOF。
+        # 标准输出和标准错误（日志）分开保存，命令输出的断言不必扫描日志
+        # 子进程放在独立的进程组中，超时后连同它启动的 proot 一起杀掉
+        with tempfile.TemporaryFile(mode="w+b") as out, tempfile.TemporaryFile(mode="w+b") as err:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if input is not None else None,
+                                    stdout=out, stderr=err, env=CHILD_ENV, start_new_session=True)
+            try:
+                proc.communicate(input, timeout=COMMAND_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+                raise
+            out.seek(0)
+            err.seek(0)
+            output = out.read().decode("utf-8", errors="replace")
+            errors = err.read().decode("utf-8", errors="replace")
+        return subprocess.CompletedProcess(cmd, proc.returncode, output, errors)
+
+    @staticmethod
+    def _describe(result):
+        """命令失败时用于断言信息的完整输出。"""
+        return f"{result.args}\n{result.stdout or ''}{result.stderr or ''}"
+
+    def _run_streaming(self, command, match, timeout):
+        """逐行读取命令输出，出现 match 或超时后结束命令，返回已读到的输出。"""
+        cmd = [*self.BASE_CMD, *command]
+        if VERBOSE:
+            print(f"\nExecuting: {' '.join(cmd)}")
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                encoding="utf-8", errors="replace", bufsize=1,
+                                env={**CHILD_ENV, "PYTHONUNBUFFERED": "1"}, start_new_session=True)
+        # 读取一行时会一直阻塞，超时由定时器杀掉进程组，使读取遇到EOF
+        timer = threading.Timer(timeout, os.killpg, (proc.pid, signal.SIGKILL))
+        timer.start()
+        lines = []
+        try:
+            for line in proc.stdout:
+                lines.append(line)
+                if match in line:
+                    break
+        finally:
+            timer.cancel()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.stdout.close()
+            proc.wait()
+        return subprocess.CompletedProcess(cmd, proc.returncode, "".join(lines))
+
+    def _remove_on_cleanup(self, container_name):
+        """测试结束时强制删除容器，测试中途失败跳过了清理步骤时也不会留下后台进程。"""
+        def remove():
+            try:
+                with open(os.path.join(self.TEST_CACHE_DIR, "containers.json")) as f:
+                    containers = json.load(f)
+            except (OSError, ValueError):
+                return
+            if container_name in containers:
+                self._execute(["rm", "-f", container_name])
+        self.addCleanup(remove)
+
+    def _run_batch(self, commands, expect_success=True):
+        """通过 docker batch 在同一进程中依次执行多条命令，按命令返回结果列表。"""
+        script = "".join(shlex.join(command) + "\n" for command in commands)
+        if VERBOSE:
+            print(script, end="")
+        batch = self._execute(["batch"], input=script.encode())
+        output = batch.stdout
+
+        # 每条命令的输出之后是一行 "---SEP--- <退出状态>"
+        results, lines = [], []
+        for line in output.splitlines(keepends=True):
+            if line.startswith(BATCH_SEPARATOR + " ") and len(results) < len(commands):
+                status = int(line.split()[1])
+                results.append(subprocess.CompletedProcess(commands[len(results)], status, "".join(lines)))
+                lines = []
+            else:
+                lines.append(line)
+        self.assertEqual(len(results), len(commands), f"batch 未执行完所有命令: {self._describe(batch)}")
+
+        if expect_success:
+            for result in results:
+                # 各命令的日志都在 batch 的标准错误中
+                self.assertEqual(result.returncode, 0,
+                                 f"命令执行失败: {result.args}\n{result.stdout}{batch.stderr}")
+        return results
+
+    def _wait_until(self, predicate, timeout=10, initial=0.05):
+        """按指数退避反复检查 predicate，直到为真或超时，返回最后一次的结果。"""
+        deadline = time.monotonic() + timeout
+        delay = initial
+        while True:
+            result = predicate()
+            if result or time.monotonic() >= deadline:
+                return result
+            time.sleep(delay)
+            delay = min(delay * 1.6, 0.5)
+
+    def _http_get(self, url):
+        """请求 url 并返回响应内容，连接失败时返回 None；不经过环境变量中的代理。"""
+        opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+        try:
+            with opener.open(url, timeout=1) as response:
+                return response.read().decode(errors="replace")
+        except OSError:
+            return None
 
     def _run_command(self, command, expect_success=True):
         """执行 docker_cli.py 命令并返回结果。"""
-        # Run as a module to ensure correct package imports
-        cmd = [sys.executable, "-m", "android_docker.docker_cli", "--cache-dir", self.TEST_CACHE_DIR] + command
-        print(f"\nExecuting: {' '.join(cmd)}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        
+        result = self._execute(command)
+
         if expect_success:
-            self.assertEqual(result.returncode, 0, f"命令执行失败: {result.stdout}")
+            self.assertEqual(result.returncode, 0, f"命令执行失败: {self._describe(result)}")
         else:
             self.assertNotEqual(result.returncode, 0, "命令预期失败但成功了。")
             
@@ -43,13 +185,15 @@ class TestDockerCLI(unittest.TestCase):
 
     def test_01_pull_image(self):
         """测试 docker pull"""
+        # setUpClass 已拉取过该镜像，通常命中缓存；标签在此期间更新时会重新下载
         result = self._run_command(["pull", self.TEST_IMAGE])
-        self.assertIn("镜像拉取成功", result.stdout)
+        self.assertRegex(result.stderr, "镜像已存在于缓存中|镜像拉取成功")
 
     def test_02_images_list(self):
         """测试 docker images"""
+        # 镜像列表通过日志输出
         result = self._run_command(["images"])
-        self.assertIn(self.TEST_IMAGE, result.stdout)
+        self.assertIn(self.TEST_IMAGE, result.stderr)
 
     def test_03_run_foreground(self):
         """测试 docker run (前台)"""
@@ -59,7 +203,8 @@ class TestDockerCLI(unittest.TestCase):
 
     def test_04_run_detached_and_ps(self):
         """测试 docker run -d 和 docker ps"""
-        container_name = "test-detached"
+        container_name = f"test-detached-{WORKER}"
+        self._remove_on_cleanup(container_name)
         self._run_command(["run", "-d", "--name", container_name, self.TEST_IMAGE, "sleep", "10"])
         
         result = self._run_command(["ps"])
@@ -67,58 +212,70 @@ class TestDockerCLI(unittest.TestCase):
         self.assertIn("running", result.stdout)
 
         # 清理
-        self._run_command(["stop", container_name])
-        self._run_command(["rm", container_name])
+        self._run_batch([["stop", container_name], ["rm", container_name]])
 
     def test_05_lifecycle_stop_start_rm(self):
         """测试 docker stop, start, rm"""
-        container_name = "test-lifecycle"
+        container_name = f"test-lifecycle-{WORKER}"
+        self._remove_on_cleanup(container_name)
         self._run_command(["run", "-d", "--name", container_name, self.TEST_IMAGE, "sleep", "10"])
 
         # Stop
-        self._run_command(["stop", container_name])
-        result = self._run_command(["ps", "-a"])
+        _, result = self._run_batch([["stop", container_name], ["ps", "-a"]])
         self.assertIn(container_name, result.stdout)
         self.assertIn("exited", result.stdout)
 
         # Start
-        self._run_command(["start", container_name])
-        result = self._run_command(["ps"])
+        _, result = self._run_batch([["start", container_name], ["ps"]])
         self.assertIn(container_name, result.stdout)
         self.assertIn("running", result.stdout)
 
         # RM
-        self._run_command(["stop", container_name]) # Must be stopped to be removed without force
-        self._run_command(["rm", container_name])
-        result = self._run_command(["ps", "-a"])
+        # Must be stopped to be removed without force
+        *_, result = self._run_batch([["stop", container_name], ["rm", container_name], ["ps", "-a"]])
         self.assertNotIn(container_name, result.stdout)
 
     def test_06_logs(self):
         """测试 docker logs"""
-        container_name = "test-logs"
+        container_name = f"test-logs-{WORKER}"
+        self._remove_on_cleanup(container_name)
         log_line_1 = "log line 1"
         log_line_2 = "log line 2"
         self._run_command(["run", "-d", "--name", container_name, self.TEST_IMAGE, "sh", "-c", f"echo {log_line_1}; sleep 1; echo {log_line_2}"])
         
-        time.sleep(2) # 等待容器产生日志
+        # 跟随日志，第二行出现后立即返回
+        result = self._run_streaming(["logs", "-f", container_name], match=log_line_2, timeout=10)
+        self.assertIn(log_line_1, result.stdout)
+        self.assertIn(log_line_2, result.stdout)
 
-        result = self._run_command(["logs", container_name])
+        # 查看日志后清理
+        result, _ = self._run_batch([["logs", container_name], ["rm", "-f", container_name]])
         self.assertIn(log_line_1, result.stdout)
         self.assertIn(log_line_2, result.stdout)
 
-        # 清理
-        self._run_command(["rm", "-f", container_name])
+    def test_07_concurrent_run_detached(self):
+        """测试同时执行多个 docker run -d，所有容器记录都保留下来"""
+        names = [f"test-concurrent-{WORKER}-{i}" for i in range(4)]
+        for name in names:
+            self._remove_on_cleanup(name)
+        results = {}
 
-    def test_07_rmi(self):
-        """测试 docker rmi"""
-        # 确保没有容器正在使用该镜像
-        result = self._run_command(["ps", "-a"])
-        if self.TEST_IMAGE in result.stdout:
-            print("警告: 在 rmi 测试前发现有残留容器，可能导致测试失败。")
+        def run(name):
+            results[name] = self._execute(["run", "-d", "--name", name, self.TEST_IMAGE, "sleep", "10"])
 
-        self._run_command(["rmi", self.TEST_IMAGE])
-        result = self._run_command(["images"])
-        self.assertNotIn(self.TEST_IMAGE, result.stdout)
+        threads = [threading.Thread(target=run, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for name in names:
+            self.assertEqual(results[name].returncode, 0, f"命令执行失败: {self._describe(results[name])}")
+
+        result = self._run_command(["ps"])
+        for name in names:
+            self.assertIn(name, result.stdout)
+
+        self._run_batch([["rm", "-f", name] for name in names])
 
     def test_08_run_with_env_vars_after_image(self):
         """测试在镜像名称后传递环境变量"""
@@ -145,11 +302,13 @@ class TestDockerCLI(unittest.TestCase):
 
     def test_09_run_with_volume_mount(self):
         """测试 docker run -v (volume mount)"""
-        container_name = "my-nginx"
-        nginx_image = "swr.cn-north-4.myhuaweicloud.com/ddn-k8s/docker.io/library/nginx:alpine"
-        
-        # 首先拉取 nginx 镜像
-        self._run_command(["pull", nginx_image])
+        container_name = f"my-nginx-{WORKER}"
+        self._remove_on_cleanup(container_name)
+        nginx_image = self.NGINX_IMAGE
+
+        # 等待 setUpClass 中开始的 nginx 镜像拉取完成
+        result = self._nginx_pull.result()
+        self.assertEqual(result.returncode, 0, f"拉取 nginx 镜像失败: {self._describe(result)}")
 
         # 创建一个本地的 nginx.conf 文件给测试使用
         local_conf_path = os.path.join(self.TEST_CACHE_DIR, "nginx.conf")
@@ -175,19 +334,105 @@ class TestDockerCLI(unittest.TestCase):
         self.assertIn(container_name, result.stdout)
         self.assertIn("running", result.stdout)
 
-        # 等待 nginx 启动
-        time.sleep(3)
+        # 等待 nginx 启动并开始响应请求；配置错误导致启动失败时等到超时，由下面的日志检查报告
+        self._wait_until(lambda: self._http_get("http://127.0.0.1:8088/") == "volume test ok")
 
         # 检查日志，确认 nginx 是否因为我们的配置而正常启动
         # Nginx 默认不会输出太多日志，但如果配置错误，这里会有错误信息
         log_result = self._run_command(["logs", container_name])
         self.assertNotIn("nginx: [emerg]", log_result.stdout, "Nginx 配置文件似乎导致了启动错误")
 
-        # 清理
-        self._run_command(["stop", container_name])
-        self._run_command(["rm", container_name])
-        self._run_command(["rmi", nginx_image])
+        # 清理；nginx 镜像与测试镜像一样留在缓存中供下次运行使用
+        self._run_batch([["stop", container_name], ["rm", container_name]])
+
+    def test_99_rmi(self):
+        """测试 docker rmi"""
+        # 删除临时打上的标签，共享的测试镜像留在缓存中，下次运行不必重新下载
+        throwaway_image = f"{self.TEST_IMAGE.rsplit(':', 1)[0]}:rmi-test-{WORKER}"
+        self._run_command(["tag", self.TEST_IMAGE, throwaway_image])
+        result = self._run_command(["images"])
+        self.assertIn(throwaway_image, result.stderr)
+
+        self._run_command(["rmi", throwaway_image])
+        result = self._run_command(["images"])
+        self.assertNotIn(throwaway_image, result.stderr)
+        self.assertIn(self.TEST_IMAGE, result.stderr)
+
+
+class TestContainerRecords(unittest.TestCase):
+    """
+    多个进程和线程同时修改 containers.json 时不丢失记录。
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+
+    def test_concurrent_updates(self):
+        """测试并发写入的容器记录都保留下来"""
+        from android_docker.docker_cli import DockerCLI
+        script = (
+            "import sys\n"
+            "from android_docker.docker_cli import DockerCLI\n"
+            "cli = DockerCLI(cache_dir=sys.argv[1])\n"
+            "for i in range(20):\n"
+            "    cli._update_container(f'{sys.argv[2]}-{i}', {'status': 'created'})\n"
+        )
+        procs = [subprocess.Popen([sys.executable, "-c", script, self.cache_dir, f"proc{n}"], env=CHILD_ENV)
+                 for n in range(4)]
+
+        def update(prefix):
+            cli = DockerCLI(cache_dir=self.cache_dir)
+            for i in range(20):
+                cli._update_container(f"{prefix}-{i}", {"status": "created"})
+                cli._patch_container(f"{prefix}-{i}", status="running", pid=i)
+
+        threads = [threading.Thread(target=update, args=(f"thread{n}",)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for proc in procs:
+            self.assertEqual(proc.wait(timeout=COMMAND_TIMEOUT), 0)
+
+        containers = DockerCLI(cache_dir=self.cache_dir)._load_containers()
+        self.assertEqual(len(containers), 160)
+        self.assertEqual(containers["thread3-19"], {"status": "running", "pid": 19})
+
+    def test_patch_removed_container(self):
+        """测试修改已被删除的容器记录时不会重新创建它"""
+        from android_docker.docker_cli import DockerCLI
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertFalse(cli._patch_container("gone", status="running", pid=1))
+        self.assertNotIn("gone", cli._load_containers())
+
+
+class TestInspectSize(unittest.TestCase):
+    """
+    inspect 报告的镜像大小默认包含所有文件。
+    """
+
+    def _inspect_size(self, env):
+        from android_docker.docker_cli import DockerCLI
+        with tempfile.TemporaryDirectory() as cache_dir:
+            image_dir = os.path.join(cache_dir, "images", "demo_latest")
+            for name in (".git", "proc", "usr"):
+                os.makedirs(os.path.join(image_dir, name))
+                with open(os.path.join(image_dir, name, "data"), "wb") as f:
+                    f.write(b"x" * 100)
+            cli = DockerCLI(cache_dir=cache_dir)
+            with mock.patch.dict(os.environ, env), mock.patch("sys.stdout", new_callable=io.StringIO) as out:
+                self.assertTrue(cli.inspect("demo:latest"))
+            return json.loads(out.getvalue())["Size"]
+
+    def test_full_size_by_default(self):
+        """测试默认统计隐藏目录和proc等目录中的文件"""
+        self.assertEqual(self._inspect_size({}), 300)
+
+    def test_prune_from_env(self):
+        """测试设置 ANDROID_DOCKER_SIZE_PRUNE 后跳过对应目录"""
+        self.assertEqual(self._inspect_size({"ANDROID_DOCKER_SIZE_PRUNE": ".*,proc"}), 100)
 
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
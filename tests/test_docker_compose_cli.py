@@ -2,24 +2,34 @@ import unittest
 import os
 import sys
 import subprocess
-import shutil
+import compileall
+import json
+import tempfile
+from unittest import mock
+
 import yaml
 
+from tests.helpers import WORKER, CHILD_ENV, VERBOSE, PACKAGE_DIR, reset_test_cache
+
+# 不使用常驻守护进程，每条命令都在新进程中执行测试中的代码
+CHILD_ENV = {**CHILD_ENV, "ANDROID_DOCKER_DAEMON": "0"}
+
+
 class TestDockerComposeCLI(unittest.TestCase):
     """
     对 docker_compose_cli.py 进行集成测试。
     """
     TEST_IMAGE = "swr.cn-north-4.myhuaweicloud.com/ddn-k8s/docker.io/library/alpine:latest"
-    TEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".docker_proot_cache_test_compose")
-    COMPOSE_FILE_PATH = "docker-compose.test.yml"
+    TEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), f".docker_proot_cache_test_compose_{WORKER}")
+    COMPOSE_FILE_PATH = f"docker-compose.test.{WORKER}.yml"
 
     @classmethod
     def setUpClass(cls):
         """在所有测试开始前，准备环境。"""
-        # 清理并创建测试缓存目录
-        if os.path.exists(cls.TEST_CACHE_DIR):
-            shutil.rmtree(cls.TEST_CACHE_DIR)
-        os.makedirs(cls.TEST_CACHE_DIR)
+        # 清理容器状态并创建测试缓存目录，镜像缓存保留
+        reset_test_cache(cls.TEST_CACHE_DIR)
+        os.makedirs(cls.TEST_CACHE_DIR, exist_ok=True)
+        compileall.compile_dir(PACKAGE_DIR, quiet=1)
 
         # 创建一个临时的 docker-compose 文件
         compose_config = {
@@ -42,14 +52,13 @@ class TestDockerComposeCLI(unittest.TestCase):
 
         # 先拉取镜像，避免重复下载影响测试速度
         cmd = [sys.executable, "-m", "android_docker.docker_cli", "--cache-dir", cls.TEST_CACHE_DIR, "pull", cls.TEST_IMAGE]
-        subprocess.run(cmd, capture_output=True)
+        subprocess.run(cmd, capture_output=True, env=CHILD_ENV)
 
 
     @classmethod
     def tearDownClass(cls):
         """在所有测试结束后，清理环境。"""
-        if os.path.exists(cls.TEST_CACHE_DIR):
-            shutil.rmtree(cls.TEST_CACHE_DIR)
+        reset_test_cache(cls.TEST_CACHE_DIR)
         if os.path.exists(cls.COMPOSE_FILE_PATH):
             os.remove(cls.COMPOSE_FILE_PATH)
 
@@ -61,10 +70,17 @@ class TestDockerComposeCLI(unittest.TestCase):
             "-f", self.COMPOSE_FILE_PATH
         ] + command
         
-        print(f"\nExecuting: {' '.join(cmd)}")
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if VERBOSE:
+            print(f"\nExecuting: {' '.join(cmd)}")
+        # 输出写入临时文件而不是管道：不受管道缓冲区限制，
+        # 也不会因为后台容器进程继承了管道写端而一直等不到EOF
+        with tempfile.TemporaryFile(mode="w+b") as out:
+            proc = subprocess.run(cmd, stdout=out, stderr=subprocess.STDOUT, env=CHILD_ENV, check=False)
+            out.seek(0)
+            output = out.read().decode("utf-8", errors="replace")
+        result = subprocess.CompletedProcess(cmd, proc.returncode, output)
         
-        self.assertEqual(result.returncode, 0, f"Compose 命令执行失败: {result.stdout}")
+        self.assertEqual(result.returncode, 0, f"Compose 命令执行失败: {result.args}\n{result.stdout}")
         return result
 
     def test_compose_up_and_down(self):
@@ -76,7 +92,7 @@ class TestDockerComposeCLI(unittest.TestCase):
 
         # Check with ps
         ps_cmd = [sys.executable, "-m", "android_docker.docker_cli", "--cache-dir", self.TEST_CACHE_DIR, "ps"]
-        result_ps = subprocess.run(ps_cmd, capture_output=True, text=True)
+        result_ps = subprocess.run(ps_cmd, capture_output=True, encoding="utf-8", errors="replace", env=CHILD_ENV)
         self.assertIn("compose-test-app", result_ps.stdout)
         self.assertIn("compose-test-db", result_ps.stdout)
         self.assertIn("running", result_ps.stdout)
@@ -90,10 +106,76 @@ class TestDockerComposeCLI(unittest.TestCase):
 
         # Check with ps -a
         psa_cmd = [sys.executable, "-m", "android_docker.docker_cli", "--cache-dir", self.TEST_CACHE_DIR, "ps", "-a"]
-        result_psa = subprocess.run(psa_cmd, capture_output=True, text=True)
+        result_psa = subprocess.run(psa_cmd, capture_output=True, encoding="utf-8", errors="replace", env=CHILD_ENV)
         self.assertNotIn("compose-test-app", result_psa.stdout)
         self.assertNotIn("compose-test-db", result_psa.stdout)
 
 
+class TestDaemonFallback(unittest.TestCase):
+    """
+    守护进程不可用或回复无法解析时改用子进程执行。
+    """
+
+    def test_fallback_on_bad_reply(self):
+        """测试守护进程回复无法解析时回退到子进程"""
+        from android_docker import cli_daemon, docker_compose_cli
+        for error in (ConnectionRefusedError(), ValueError("bad json"), KeyError("status")):
+            with self.subTest(error=error), \
+                    mock.patch.dict(os.environ, {"ANDROID_DOCKER_DAEMON": "1"}), \
+                    mock.patch.object(cli_daemon, "send_stages", side_effect=error), \
+                    mock.patch.object(docker_compose_cli.subprocess, "run") as run:
+                docker_compose_cli.run_docker_cli_commands([[("ps", [])]], use_daemon=True)
+            run.assert_called_once()
+
+
+
+class TestUpStages(unittest.TestCase):
+    """
+    只有后台模式并发启动服务，前台模式按顺序逐个启动。
+    """
+
+    def _up_stages(self, detach):
+        from android_docker import docker_compose_cli
+        config = {"services": {"app": {"image": "alpine"}, "db": {"image": "alpine"}}}
+        args = mock.Mock(file="docker-compose.yml", cache_dir=None, detach=detach)
+        with mock.patch.object(docker_compose_cli, "parse_compose_file", return_value=config), \
+                mock.patch.object(docker_compose_cli, "run_docker_cli_commands") as run, \
+                mock.patch.object(docker_compose_cli, "wait_ready", return_value=True):
+            docker_compose_cli.cmd_up(args)
+        return run.call_args[0][0]
+
+    def test_detached_up_is_one_stage(self):
+        """测试 up -d 把所有服务放在同一阶段"""
+        self.assertEqual([len(stage) for stage in self._up_stages(True)], [2])
+
+    def test_foreground_up_is_sequential(self):
+        """测试前台 up 每个阶段只启动一个服务"""
+        self.assertEqual([len(stage) for stage in self._up_stages(False)], [1, 1])
+
+
+class TestLazyImports(unittest.TestCase):
+    """
+    导入 docker_compose_cli 不加载 docker_cli，等待容器时直接读取 containers.json。
+    """
+
+    def test_import_skips_docker_cli(self):
+        """测试导入模块时不加载 docker_cli、proot_runner 和 cli_daemon"""
+        code = ("import sys, android_docker.docker_compose_cli\n"
+                "print(sorted(m for m in ('android_docker.docker_cli', 'android_docker.proot_runner',\n"
+                "                         'android_docker.cli_daemon') if m in sys.modules))")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(PACKAGE_DIR), check=True)
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_wait_ready_reads_containers_file(self):
+        """测试 wait_ready 根据 containers.json 中的状态返回"""
+        from android_docker import docker_compose_cli
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with open(os.path.join(cache_dir, "containers.json"), "w") as f:
+                json.dump({"app": {"status": "running"}, "db": {"status": "exited"}}, f)
+            self.assertTrue(docker_compose_cli.wait_ready("app", cache_dir=cache_dir))
+            self.assertFalse(docker_compose_cli.wait_ready("db", cache_dir=cache_dir))
+            self.assertFalse(docker_compose_cli.wait_ready("missing", cache_dir=cache_dir, timeout=0.05))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
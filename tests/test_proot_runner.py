@@ -0,0 +1,403 @@
+import unittest
+import argparse
+import io
+import os
+import shlex
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+from unittest import mock
+
+from android_docker import create_rootfs_tar, proot_runner
+from android_docker.docker_cli import DockerCLI
+
+
+class TestSpawnProcess(unittest.TestCase):
+    """
+    spawn_process 的 posix_spawnp 路径和退回 subprocess 的路径行为一致。
+    """
+
+    def _spawn_and_read(self):
+        """启动子进程输出会话ID和环境变量，返回 (退出状态, 输出)。"""
+        with tempfile.TemporaryFile() as out:
+            cmd = ["sh", "-c", "echo $SPAWN_TEST; ps -o sid= -p $$ 2>/dev/null || echo nosid"]
+            env = {**os.environ, "SPAWN_TEST": "spawned"}
+            pid = proot_runner.spawn_process(cmd, env, (None, out.fileno(), None), new_session=True)
+            _, status = proot_runner.wait_process(pid)
+            out.seek(0)
+            return status, out.read().decode(), pid
+
+    def test_posix_spawn(self):
+        """测试使用 posix_spawnp 启动"""
+        if not proot_runner._HAVE_POSIX_SPAWN:
+            self.skipTest("当前平台没有 os.posix_spawnp")
+        status, output, _ = self._spawn_and_read()
+        self.assertEqual(status, 0)
+        self.assertIn("spawned", output)
+
+    def test_fallback_without_posix_spawn(self):
+        """测试没有 os.posix_spawnp 时退回 subprocess.Popen"""
+        with mock.patch.object(proot_runner, "_HAVE_POSIX_SPAWN", False), \
+                mock.patch.object(proot_runner.subprocess, "Popen", wraps=proot_runner.subprocess.Popen) as popen:
+            status, output, pid = self._spawn_and_read()
+        self.assertTrue(popen.called)
+        self.assertEqual(status, 0)
+        self.assertIn("spawned", output)
+        # 新会话的会话ID就是子进程自己的PID
+        if "nosid" not in output:
+            self.assertEqual(int(output.split()[1]), pid)
+        self.assertNotIn(pid, proot_runner._popen_children)
+
+    def test_fallback_when_setsid_unsupported(self):
+        """测试 posix_spawnp 不支持 setsid 时退回 subprocess.Popen"""
+        with mock.patch.object(proot_runner.os, "posix_spawnp", side_effect=NotImplementedError, create=True), \
+                mock.patch.object(proot_runner, "_HAVE_POSIX_SPAWN", True):
+            status, output, _ = self._spawn_and_read()
+        self.assertEqual(status, 0)
+        self.assertIn("spawned", output)
+
+
+class TestDeleteInBackground(unittest.TestCase):
+    """
+    后台删除无法启动时同步删除。
+    """
+
+    def test_spawn_failure_deletes_synchronously(self):
+        """测试启动后台删除失败（任何异常）时改为同步删除"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            runner = proot_runner.ProotRunner(cache_dir=cache_dir)
+            target = os.path.join(cache_dir, "victim", "sub")
+            os.makedirs(target)
+            with mock.patch.object(proot_runner, "spawn_process", side_effect=TypeError("setsid")):
+                runner._delete_in_background([os.path.dirname(target)])
+            self.assertFalse(os.path.exists(os.path.dirname(target)))
+
+
+class TestFindExecutable(unittest.TestCase):
+    """
+    命令查找结果按 PATH 缓存，找不到时不缓存。
+    """
+
+    def test_miss_not_cached_and_path_respected(self):
+        """测试安装命令后能找到，换用其他 PATH 时重新查找"""
+        with tempfile.TemporaryDirectory() as bin_dir, \
+                mock.patch.dict(os.environ, {"PATH": bin_dir}):
+            self.assertIsNone(proot_runner._find_executable("fake-proot"))
+            tool = os.path.join(bin_dir, "fake-proot")
+            with open(tool, "w") as f:
+                f.write("#!/bin/sh\n")
+            os.chmod(tool, 0o755)
+            self.assertEqual(proot_runner._find_executable("fake-proot"), tool)
+            with mock.patch.dict(os.environ, {"PATH": os.path.join(bin_dir, "missing")}):
+                self.assertIsNone(proot_runner._find_executable("fake-proot"))
+
+
+class TestParseImageConfig(unittest.TestCase):
+    """
+    缓存的镜像配置不会被调用方的修改污染。
+    """
+
+    def test_returns_independent_copies(self):
+        """测试修改返回的配置不影响下一次解析的结果"""
+        data = b'{"config": {"Cmd": ["sh"], "Env": ["A=1"]}}'
+        config_data, env = proot_runner._parse_image_config(data)
+        config_data["config"]["Cmd"].append("-c")
+        self.assertEqual(proot_runner._parse_image_config(data)[0]["config"]["Cmd"], ["sh"])
+        self.assertEqual(env, (("A", "1"),))
+
+
+class TestCacheDigest(unittest.TestCase):
+    """
+    下载后记录manifest摘要，再次pull时命中缓存。
+    """
+
+    IMAGE = "registry.example.com/library/alpine:latest"
+    DIGEST = "sha256:" + "0" * 64
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        source = os.path.join(self.cache_dir, "source")
+        os.makedirs(os.path.join(source, "bin"))
+
+        # 用本地打包代替 create_rootfs_tar.py 下载，output_path 为 - 时写到标准输出
+        def build_command(image_url, output_path, *args, **kwargs):
+            return ["tar", "-czf", output_path, "-C", source, "."]
+
+        for name, value in (("_build_download_command", mock.Mock(side_effect=build_command)),
+                            ("_get_remote_digest", mock.Mock(return_value=self.DIGEST))):
+            patcher = mock.patch.object(proot_runner.ProotRunner, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_second_pull_is_cache_hit(self):
+        """测试第二次 pull 只比较摘要，不再下载"""
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertTrue(cli.pull(self.IMAGE))
+        self.assertEqual(cli.runner._load_cache_info(self.IMAGE)["manifest_digest"], self.DIGEST)
+        with mock.patch.object(cli.runner, "_download_image") as download:
+            self.assertTrue(cli.pull(self.IMAGE))
+        download.assert_not_called()
+
+    def test_download_and_extract_records_digest(self):
+        """测试边下载边解压时同样记录manifest摘要"""
+        runner = proot_runner.ProotRunner(cache_dir=self.cache_dir)
+        rootfs_dir = os.path.join(self.cache_dir, "rootfs-test")
+        self.assertEqual(runner._download_and_extract(self.IMAGE, provided_rootfs_dir=rootfs_dir,
+                                                      manifest_digest=self.DIGEST), rootfs_dir)
+        self.assertTrue(os.path.isdir(os.path.join(rootfs_dir, "bin")))
+        cache_info = runner._load_cache_info(self.IMAGE)
+        self.assertTrue(runner._is_cache_current(cache_info, self.DIGEST))
+
+    def test_failed_download_leaves_rootfs_dir_empty(self):
+        """测试下载中断时持久化目录中不留下解压了一半的根文件系统"""
+        runner = proot_runner.ProotRunner(cache_dir=self.cache_dir)
+        rootfs_dir = os.path.join(self.cache_dir, "rootfs-test")
+        source = os.path.join(self.cache_dir, "source")
+        truncated = ["sh", "-c", f"tar -czf - -C {shlex.quote(source)} . | head -c 20"]
+        with mock.patch.object(runner, "_build_download_command", return_value=truncated):
+            self.assertIsNone(runner._download_and_extract(self.IMAGE, provided_rootfs_dir=rootfs_dir))
+        self.assertEqual(os.listdir(rootfs_dir), [])
+        self.assertFalse(runner._is_image_cached(self.IMAGE))
+
+    def test_prepare_without_tee_downloads_then_extracts(self):
+        """测试没有 tee 命令时先下载到缓存再解压"""
+        runner = proot_runner.ProotRunner(cache_dir=self.cache_dir)
+        rootfs_dir = os.path.join(self.cache_dir, "rootfs-test")
+        args = mock.Mock(force_download=False, username=None, password=None, tmpfs_size=0)
+        which = lambda name: None if name == "tee" else shutil.which(name)
+        with mock.patch.object(proot_runner, "_find_executable", side_effect=which), \
+                mock.patch.object(runner, "_download_and_extract") as streaming:
+            self.assertEqual(runner._prepare_rootfs(self.IMAGE, args, provided_rootfs_dir=rootfs_dir), rootfs_dir)
+        streaming.assert_not_called()
+        self.assertTrue(os.path.isdir(os.path.join(rootfs_dir, "bin")))
+        self.assertEqual(runner._load_cache_info(self.IMAGE)["manifest_digest"], self.DIGEST)
+
+    def test_stale_pull_probes_once(self):
+        """测试远端镜像更新时整个 pull 只查询一次摘要，并记录新摘要"""
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertTrue(cli.pull(self.IMAGE))
+        new_digest = "sha256:" + "1" * 64
+        with mock.patch.object(cli.runner, "_get_remote_digest", return_value=new_digest) as probe:
+            self.assertTrue(cli.pull(self.IMAGE))
+        probe.assert_called_once()
+        self.assertEqual(cli.runner._load_cache_info(self.IMAGE)["manifest_digest"], new_digest)
+
+    def test_missing_digest_is_not_stale(self):
+        """测试旧版本没有记录摘要的缓存在 pull 时不会被重新下载"""
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertTrue(cli.pull(self.IMAGE))
+        cache_info = cli.runner._load_cache_info(self.IMAGE)
+        del cache_info["manifest_digest"]
+        cli.runner._write_cache_info(self.IMAGE, cache_info)
+        with mock.patch.object(cli.runner, "_download_image") as download:
+            self.assertTrue(cli.pull(self.IMAGE))
+        download.assert_not_called()
+
+    def test_offline_probe_uses_cache(self):
+        """测试无法查询摘要（离线）时沿用缓存"""
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertTrue(cli.pull(self.IMAGE))
+        with mock.patch.object(cli.runner, "_get_remote_digest", return_value=None), \
+                mock.patch.object(cli.runner, "_download_image") as download:
+            self.assertTrue(cli.pull(self.IMAGE))
+        download.assert_not_called()
+
+    def test_hanging_probe_uses_cache(self):
+        """测试 curl 无响应时摘要探测超时返回，很快改用缓存"""
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertTrue(cli.pull(self.IMAGE))
+        # 假的 curl 忽略超时参数一直挂起，只能靠 subprocess 的超时结束
+        bin_dir = os.path.join(self.cache_dir, "bin")
+        os.makedirs(bin_dir)
+        curl = os.path.join(bin_dir, "curl")
+        with open(curl, "w") as f:
+            f.write("#!/bin/sh\nexec sleep 30\n")
+        os.chmod(curl, 0o755)
+        probe = lambda image_url, username=None, password=None: \
+            create_rootfs_tar.get_manifest_digest(image_url, username, password)
+        with mock.patch.dict(os.environ, {"PATH": bin_dir + os.pathsep + os.environ["PATH"]}), \
+                mock.patch.object(create_rootfs_tar, "_PROBE_MAX_TIME", 0.5), \
+                mock.patch.object(cli.runner, "_get_remote_digest", side_effect=probe), \
+                mock.patch.object(cli.runner, "_download_image") as download:
+            start = time.monotonic()
+            self.assertTrue(cli.pull(self.IMAGE))
+            self.assertLess(time.monotonic() - start, 5)
+        download.assert_not_called()
+
+    def test_tag_keeps_source_digest(self):
+        """测试 tag 出的新标签沿用源镜像的manifest摘要"""
+        cli = DockerCLI(cache_dir=self.cache_dir)
+        self.assertTrue(cli.pull(self.IMAGE))
+        target = "registry.example.com/library/alpine:copy"
+        self.assertTrue(cli.tag(self.IMAGE, target))
+        self.assertEqual(cli.runner._load_cache_info(target)["manifest_digest"], self.DIGEST)
+
+
+class TestRemoteDigestProbe(unittest.TestCase):
+    """
+    查询摘要失败时只记录DEBUG日志。
+    """
+
+    def test_probe_failure_is_quiet(self):
+        """测试离线时 curl 失败不会输出 INFO 及以上级别的日志"""
+        error = subprocess.CalledProcessError(6, ["curl"], output="", stderr="")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            runner = proot_runner.ProotRunner(cache_dir=cache_dir)
+            with mock.patch("android_docker.create_rootfs_tar.subprocess.run", side_effect=error), \
+                    self.assertNoLogs(level="INFO"):
+                self.assertIsNone(runner._get_remote_digest("registry.example.com/library/alpine:latest"))
+
+
+class TestExtractRootfs(unittest.TestCase):
+    """
+    解压缓存只用于拉取的镜像，从缓存复制失败时改为解压tar包。
+    """
+
+    DIGEST = "sha256:" + "0" * 64
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        source = os.path.join(self.cache_dir, "source")
+        os.makedirs(os.path.join(source, "bin"))
+        self.tar_path = os.path.join(self.cache_dir, "image.tar.gz")
+        subprocess.run(["tar", "-czf", self.tar_path, "-C", source, "."], check=True)
+        self.runner = proot_runner.ProotRunner(cache_dir=self.cache_dir)
+        self.extracted_dir = self.runner._get_extracted_rootfs_dir(self.DIGEST)
+
+    def _extract(self, name, manifest_digest=None):
+        rootfs_dir = os.path.join(self.cache_dir, name)
+        self.assertEqual(self.runner._extract_rootfs_if_needed(self.tar_path, provided_rootfs_dir=rootfs_dir,
+                                                               manifest_digest=manifest_digest), rootfs_dir)
+        self.assertTrue(os.path.isdir(os.path.join(rootfs_dir, "bin")))
+
+    def test_local_tar_is_not_cached(self):
+        """测试没有摘要的本地tar包直接解压，不写入解压缓存"""
+        self._extract("rootfs-local")
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "rootfs")))
+
+    def test_cache_filled_on_second_use(self):
+        """测试镜像第一次使用时直接解压，再次使用时才解压到缓存并复制"""
+        self._extract("rootfs-1", self.DIGEST)
+        self.assertFalse(os.path.exists(self.extracted_dir))
+        with mock.patch.object(self.runner, "_copy_extracted_rootfs", wraps=self.runner._copy_extracted_rootfs) as copy:
+            self._extract("rootfs-2", self.DIGEST)
+        copy.assert_called_once_with(self.extracted_dir)
+        self.assertTrue(os.path.isdir(os.path.join(self.extracted_dir, "bin")))
+
+    def test_clear_cache_removes_extracted_rootfs(self):
+        """测试删除镜像时同时删除其解压缓存"""
+        image = "registry.example.com/library/alpine:latest"
+        with mock.patch.object(proot_runner, "_find_executable", return_value=None):
+            self.runner._save_cache_info(image, self.tar_path, self.DIGEST)
+            self._extract("rootfs-1", self.DIGEST)
+            self._extract("rootfs-2", self.DIGEST)
+            self.runner.clear_cache(image)
+        self.assertFalse(os.path.exists(self.extracted_dir))
+        self.assertFalse(os.path.exists(self.extracted_dir + ".seen"))
+
+    def test_copy_failure_falls_back_to_tar(self):
+        """测试 cp --reflink 失败后删除复制了一半的目录并解压tar包"""
+        rootfs_dir = os.path.join(self.cache_dir, "rootfs-test")
+
+        def failing_copy(cmd, **kwargs):
+            # 模拟复制到一半失败
+            open(os.path.join(cmd[-1], "partial"), "w").close()
+            raise subprocess.CalledProcessError(1, cmd)
+
+        source = os.path.join(self.cache_dir, "source")
+        with mock.patch.object(self.runner, "_ensure_extracted_rootfs", return_value=source), \
+                mock.patch.object(proot_runner.subprocess, "run", side_effect=failing_copy):
+            self._extract("rootfs-test", self.DIGEST)
+        self.assertFalse(os.path.exists(os.path.join(rootfs_dir, "partial")))
+
+
+
+class TestTarfileFallback(unittest.TestCase):
+    """
+    tarfile 后备解压在线程池中写出小文件，结果与按顺序解压一致。
+    """
+
+    def _add_file(self, tar, name, data, mode=0o644, mtime=1600000000):
+        info = tarfile.TarInfo(name)
+        info.size, info.mode, info.mtime = len(data), mode, mtime
+        tar.addfile(info, io.BytesIO(data))
+
+    def test_pooled_writes(self):
+        """测试多核非root时小文件交给线程池写出，权限、时间、硬链接和重复路径都正确"""
+        with tempfile.TemporaryDirectory() as work_dir:
+            tar_path = os.path.join(work_dir, "rootfs.tar.gz")
+            with tarfile.open(tar_path, "w:gz") as tar:
+                for i in range(50):
+                    self._add_file(tar, f"etc/file{i}", f"small {i}".encode(), mode=0o640)
+                self._add_file(tar, "usr/big", b"x" * (proot_runner._TAR_ASYNC_LIMIT + 1))
+                self._add_file(tar, "etc/file0", b"replaced")
+                link = tarfile.TarInfo("etc/link1")
+                link.type, link.linkname = tarfile.LNKTYPE, "etc/file1"
+                tar.addfile(link)
+
+            target = os.path.join(work_dir, "rootfs")
+            os.makedirs(target)
+            runner = proot_runner.ProotRunner(cache_dir=os.path.join(work_dir, "cache"))
+            with mock.patch.object(proot_runner, "_find_executable", return_value=None), \
+                    mock.patch.object(proot_runner.os, "geteuid", return_value=1000), \
+                    mock.patch.object(proot_runner.os, "cpu_count", return_value=4), \
+                    mock.patch.object(proot_runner, "_write_file", wraps=proot_runner._write_file) as write_file:
+                runner._extract_tar(tar_path, target)
+
+            self.assertGreater(write_file.call_count, 0)
+            with open(os.path.join(target, "etc", "file0"), "rb") as f:
+                self.assertEqual(f.read(), b"replaced")
+            st = os.stat(os.path.join(target, "etc", "file7"))
+            self.assertEqual((st.st_mode & 0o777, st.st_mtime), (0o640, 1600000000))
+            self.assertEqual(os.path.getsize(os.path.join(target, "usr", "big")), proot_runner._TAR_ASYNC_LIMIT + 1)
+            with open(os.path.join(target, "etc", "link1"), "rb") as f:
+                self.assertEqual(f.read(), b"small 1")
+
+
+class TestRunWithoutTar(unittest.TestCase):
+    """
+    没有 tar 命令时用 tarfile 解压本地 tar 包并启动容器。
+    """
+
+    def _write_tool(self, bin_dir, name, body):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n" + body)
+        os.chmod(path, 0o755)
+
+    def test_run_local_tar_without_tar_command(self):
+        """测试 PATH 中没有 tar 时 run() 仍能完成解压并启动 proot"""
+        with tempfile.TemporaryDirectory() as work_dir:
+            source = os.path.join(work_dir, "source")
+            os.makedirs(os.path.join(source, "etc"))
+            with open(os.path.join(source, "etc", "hostname"), "w") as f:
+                f.write("tarfile-rootfs\n")
+            tar_path = os.path.join(work_dir, "rootfs.tar.gz")
+            with tarfile.open(tar_path, "w:gz") as tar:
+                tar.add(source, arcname=".")
+
+            # PATH 中只有假的 proot 和 curl；proot 只用shell内建命令读出根文件系统中的文件
+            bin_dir = os.path.join(work_dir, "bin")
+            os.makedirs(bin_dir)
+            output = os.path.join(work_dir, "proot.out")
+            self._write_tool(bin_dir, "proot", f'read line < "$2/etc/hostname"; echo "$line" > {shlex.quote(output)}\n')
+            self._write_tool(bin_dir, "curl", "exit 0\n")
+
+            args = argparse.Namespace(command=["true"], env=[], bind=[], workdir=None, detach=False,
+                                      interactive=False, force_download=False, log_file=None, pid_file=None,
+                                      tmpfs_size=0)
+            with mock.patch.dict(os.environ, {"PATH": bin_dir}):
+                runner = proot_runner.ProotRunner(cache_dir=os.path.join(work_dir, "cache"))
+                with mock.patch.object(runner, "_extract_tar_with_tarfile",
+                                       wraps=runner._extract_tar_with_tarfile) as fallback:
+                    self.assertTrue(runner.run(tar_path, args))
+            fallback.assert_called_once()
+            with open(output) as f:
+                self.assertEqual(f.read(), "tarfile-rootfs\n")
+
+if __name__ == '__main__':
+    unittest.main()